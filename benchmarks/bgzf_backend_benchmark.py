@@ -0,0 +1,74 @@
+#!/usr/bin/env python
+#Compare the available deflate backends on the blocks of a BGZF file
+#Not installed with the package; run it with PYTHONPATH=lib. The isal and zlib-ng backends
+#need Python 3, so on Python 2 only zlib is compared.
+import time
+from optparse import OptionParser
+
+from pyBamParser.bgzf import BGZF_EOF, HEADER_BLOCK_SIZE, deflate, get_available_deflate_backends, get_deflate_backend, scan_blocks
+
+def read_blocks( filename, max_blocks=None ):
+    #returns the ( compressed data, uncompressed size ) of each non-empty block
+    blocks = []
+    fh = open( filename, 'rb' )
+    for offset, compressed_size, uncompressed_size in scan_blocks( filename ):
+        if not uncompressed_size:
+            continue
+        fh.seek( offset + 18 )
+        blocks.append( ( fh.read( compressed_size - HEADER_BLOCK_SIZE - 1 ), uncompressed_size ) )
+        if max_blocks and len( blocks ) >= max_blocks:
+            break
+    fh.close()
+    return blocks
+
+def time_call( func, items, repeat ):
+    #best time over repeat runs of calling func on every item
+    best = None
+    for i in range( repeat ):
+        start = time.time()
+        for item in items:
+            func( item )
+        elapsed = time.time() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best
+
+def benchmark( backends, blocks, compress_level, repeat ):
+    reference = get_deflate_backend( 'zlib' )
+    cdatas = [ cdata for cdata, isize in blocks ]
+    data = map( reference.decompress, cdatas )
+    total_uncompressed = float( sum( isize for cdata, isize in blocks ) ) / 2**20
+    rval = []
+    for backend in backends:
+        #every backend must read the same blocks back to the same data
+        assert map( backend.decompress, cdatas ) == data, "Backend %s inflated a block incorrectly" % ( backend.name )
+        inflate_time = time_call( backend.decompress, cdatas, repeat )
+        new_compressor = lambda: backend.new_compressor( compress_level )
+        deflate_time = time_call( lambda block_data: deflate( block_data, new_compressor, backend ), data, repeat )
+        compressed_size = sum( len( deflate( block_data, new_compressor, backend ) ) for block_data in data ) + len( BGZF_EOF )
+        rval.append( ( backend.name, total_uncompressed / inflate_time, total_uncompressed / deflate_time, compressed_size ) )
+    return rval
+
+def main():
+    parser = OptionParser( usage="USAGE: %prog [options] file.bgzf", description="Time inflating and deflating the blocks of a BGZF file with each available deflate backend." )
+    parser.add_option( '-b', '--backend', dest='backends', action='append', default=[], help="Backend to compare (default: all importable backends). Can be given more than once." )
+    parser.add_option( '-l', '--compress-level', dest='compress_level', type='int', default=6, help="Compression level for deflate timings." )
+    parser.add_option( '-n', '--max-blocks', dest='max_blocks', type='int', default=None, help="Only use the first N blocks of the file." )
+    parser.add_option( '-r', '--repeat', dest='repeat', type='int', default=3, help="Report the best of N runs." )
+    ( options, args ) = parser.parse_args()
+    if len( args ) != 1:
+        parser.error( "Provide a BGZF file." )
+
+    if options.backends:
+        backends = [ get_deflate_backend( name ) for name in options.backends ]
+    else:
+        backends = get_available_deflate_backends()
+    blocks = read_blocks( args[0], options.max_blocks )
+    if not blocks:
+        parser.error( "No data blocks found in %s." % ( args[0] ) )
+    print "#backend\tinflate_MB_per_s\tdeflate_MB_per_s\tcompressed_bytes"
+    for name, inflate_rate, deflate_rate, compressed_size in benchmark( backends, blocks, options.compress_level, options.repeat ):
+        print "%s\t%.1f\t%.1f\t%i" % ( name, inflate_rate, deflate_rate, compressed_size )
+
+if __name__ == "__main__":
+    main()
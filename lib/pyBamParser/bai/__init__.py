@@ -7,7 +7,8 @@ from ..util.packer import pack_int8, unpack_int8, pack_uint8, unpack_uint8, pack
 BAI_MAGIC = 'BAI\x01'
 BAI_MAX_BINS = 37450 #(((1<<18)-1)/7) + 1 ; (8**6-1)/7+1
 BAI_BINS = [None] * BAI_MAX_BINS
-BAI_WINDOW_SIZE = 2 ** 14
+BAI_WINDOW_SHIFT = 14
+BAI_WINDOW_SIZE = 2 ** BAI_WINDOW_SHIFT
 
 class Reader( object ):
     
@@ -44,8 +45,7 @@ class Reader( object ):
                 intv = []
                 for l in range( n_intv ):
                     offset = unpack_uint64( self._fh.read( 8 ) )[0]
-                    if offset: #only append non-zero offsets
-                        intv.append( ( offset >> 16, offset & 0xFFFF ) )
+                    intv.append( ( offset >> 16, offset & 0xFFFF ) ) #keep zero offsets too, so that the list stays indexed by window
                 self._references.append( { 'bins': bins, 'intv': intv } )
                 # determine idxstats
                 idxstats = raw_bins.get( BAI_MAX_BINS, [] )
@@ -75,65 +75,181 @@ class Reader( object ):
             end = ref[1]
         return start, end
     
-    def jump_to_region( self, seq_id, start, end ):
+    def get_chunks( self, seq_id, start, end ):
+        #returns the sorted, merged ( chunk_beg, chunk_end ) virtual offsets that can hold reads overlapping [start,end) (zero-based)
         if isinstance( seq_id, basestring ):
             seq_id = self._bam_reader.get_reference_id_by_name( seq_id )
         if seq_id is None or seq_id < 0 or seq_id >= len( self._references ):
-            return False
+            return []
         
         start, end = self._fix_region( seq_id, start, end )
         seq_bins = self._references[ seq_id ]
-
-        try:
-            linear = offset = seq_bins['intv'][start / BAI_WINDOW_SIZE ]
-        except Exception:
-            linear = offset = -1
-
-        bin_list = self.reg2bins( start, end )
-        for bin in seq_bins['bins']:
-            if bin in bin_list:
-                for left, right in seq_bins['bins'][bin]:
-                    if right >= linear:
-                        if left < offset:
-                            offset = left
-
-        if offset == -1:
+        
+        #reads overlapping the region cannot start before the linear index offset of its first window
+        intv = seq_bins['intv']
+        if intv:
+            linear = intv[ min( start >> BAI_WINDOW_SHIFT, len( intv ) - 1 ) ]
+        else:
+            linear = ( 0, 0 )
+        
+        chunks = []
+        bins = seq_bins['bins']
+        for bin in self.reg2bins( start, end ):
+            for chunk_beg, chunk_end in bins.get( bin, [] ):
+                if chunk_end > linear:
+                    chunks.append( ( max( chunk_beg, linear ), chunk_end ) )
+        return merge_chunks( chunks )
+    
+    def jump_to_region( self, seq_id, start, end ):
+        chunks = self.get_chunks( seq_id, start, end )
+        if not chunks:
             return False
-        self._bam_reader.seek_virtual( offset )
+        self._bam_reader.seek_virtual( chunks[0][0] )
         return True
     
+    def get_reference_counts( self, seq_id ):
+        #returns ( n_mapped, n_unmapped ) for a reference from its pseudo-bin, ( 0, 0 ) for a reference without reads,
+        #or ( None, None ) when the index has no pseudo-bin for it
+        ref = self._references[ seq_id ]
+        if ref['n_mapped'] is None and not ref['bins']:
+            return ( 0, 0 )
+        return ( ref['n_mapped'], ref['n_unmapped'] )
+    
+    def get_unaligned_count( self ):
+        #reads without a reference
+        return self._unaligned_count
+    
     def reg2bins( self, beg, end ):
-        #calculate the list of bins that may overlap with region [beg,end) (zero-based)
-        bins = [0]
-        if beg >= end:
-            return bins
-        for i in range( 1 + ( beg >> 26 ), 1 + ( end >> 26  ) ):
-            bins.append( i )
-        
-        for i in range( 9 + ( beg >> 23 ), 9 + ( end >> 23 ) ):
-            bins.append( i )
-        
-        for i in range( 73 + ( beg >> 20 ), 73 + ( end >> 20 ) ):
-            bins.append( i )
-        
-        for i in range( 585 + ( beg >> 17 ), 585 + ( end >> 17 ) ):
-            bins.append( i )
-        
-        for i in range( 4681 + ( beg >> 14 ), 4681 + ( end >> 14 ) ):
-            bins.append( i )
-        return bins
+        return reg2bins( beg, end )
     
     def reg2bin( self, beg, end ):
-        #calculate bin given an alignment covering [beg,end) (zero-based, half-close-half-open)
-        end -= 1#end
-        if (beg>>14 == end>>14):
-            return ((1<<15)-1)/7 + (beg>>14)
-        if (beg>>17 == end>>17):
-            return ((1<<12)-1)/7 + (beg>>17)
-        if (beg>>20 == end>>20):
-            return ((1<<9)-1)/7 + (beg>>20)
-        if (beg>>23 == end>>23):
-            return ((1<<6)-1)/7 + (beg>>23)
-        if (beg>>26 == end>>26):
-            return ((1<<3)-1)/7 + (beg>>26)
-        return 0
+        return reg2bin( beg, end )
+
+class Writer( object ):
+    #builds a BAM index from the records of a coordinate sorted BAM as they are written
+    
+    def __init__( self, n_ref ):
+        self._n_ref = n_ref
+        self._references = [ None ] * n_ref
+        self._n_no_coor = 0
+        self._last_ref_id = None
+        self._last_pos = None
+    
+    def add( self, ref_id, beg, end, flag, offset_beg, offset_end ):
+        #beg and end are zero-based, half-open; offsets are virtual offsets as ( block, offset within block ) tuples for the start and end of the record
+        offset_beg = offset_beg[0] << 16 | offset_beg[1]
+        offset_end = offset_end[0] << 16 | offset_end[1]
+        if ref_id < 0:
+            self._n_no_coor += 1
+            self._last_ref_id = self._n_ref
+            return
+        assert self._last_ref_id is None or ( ref_id, beg ) >= ( self._last_ref_id, self._last_pos ), "BAM records must be coordinate sorted to be indexed (reference %i position %i follows reference %s position %s)." % ( ref_id, beg, self._last_ref_id, self._last_pos )
+        self._last_ref_id = ref_id
+        self._last_pos = beg
+        ref = self._references[ ref_id ]
+        if ref is None:
+            ref = self._references[ ref_id ] = { 'bins': {}, 'intv': {}, 'unmapped_beg': offset_beg, 'unmapped_end': offset_end, 'n_mapped': 0, 'n_unmapped': 0 }
+        ref['unmapped_end'] = offset_end
+        if flag & 0x4:
+            ref['n_unmapped'] += 1
+        else:
+            ref['n_mapped'] += 1
+        if end <= beg:
+            end = beg + 1
+        chunks = ref['bins'].setdefault( reg2bin( beg, end ), [] )
+        if chunks and chunks[-1][1] >> 16 >= offset_beg >> 16:
+            #still within the block where the last chunk of this bin ended
+            chunks[-1][1] = offset_end
+        else:
+            chunks.append( [ offset_beg, offset_end ] )
+        intv = ref['intv']
+        for window in xrange( beg >> BAI_WINDOW_SHIFT, ( ( end - 1 ) >> BAI_WINDOW_SHIFT ) + 1 ):
+            if window not in intv:
+                intv[ window ] = offset_beg
+    
+    def write( self, filename, get_block_file_offset=None ):
+        #get_block_file_offset converts block numbers in the virtual offsets given to add() into file offsets
+        if get_block_file_offset is None:
+            resolve = lambda offset: offset
+        else:
+            resolve = lambda offset: get_block_file_offset( offset >> 16 ) << 16 | offset & 0xFFFF
+        fh = open( filename, 'wb' )
+        fh.write( BAI_MAGIC )
+        fh.write( pack_int32( self._n_ref ) )
+        for ref in self._references:
+            if ref is None:
+                fh.write( pack_int32( 0 ) ) #n_bin
+                fh.write( pack_int32( 0 ) ) #n_intv
+                continue
+            bins = ref['bins']
+            fh.write( pack_int32( len( bins ) + 1 ) )
+            for bin in sorted( bins ):
+                fh.write( pack_uint32( bin ) )
+                fh.write( pack_int32( len( bins[ bin ] ) ) )
+                for chunk_beg, chunk_end in bins[ bin ]:
+                    fh.write( pack_uint64( resolve( chunk_beg ) ) )
+                    fh.write( pack_uint64( resolve( chunk_end ) ) )
+            #pseudo-bin holding the offsets spanned by the reference and its read counts
+            fh.write( pack_uint32( BAI_MAX_BINS ) )
+            fh.write( pack_int32( 2 ) )
+            fh.write( pack_uint64( resolve( ref['unmapped_beg'] ) ) )
+            fh.write( pack_uint64( resolve( ref['unmapped_end'] ) ) )
+            fh.write( pack_uint64( ref['n_mapped'] ) )
+            fh.write( pack_uint64( ref['n_unmapped'] ) )
+            intv = ref['intv']
+            n_intv = max( intv ) + 1
+            fh.write( pack_int32( n_intv ) )
+            offset = intv[ min( intv ) ] #windows before the first read start at the first read
+            for window in xrange( n_intv ):
+                offset = intv.get( window, offset ) #windows without a read starting in them reuse the previous offset
+                fh.write( pack_uint64( resolve( offset ) ) )
+        fh.write( pack_uint64( self._n_no_coor ) )
+        fh.close()
+
+def merge_chunks( chunks ):
+    #sort ( chunk_beg, chunk_end ) virtual offset pairs, merging those that overlap, touch or share a block
+    merged = []
+    for chunk_beg, chunk_end in sorted( chunks ):
+        if merged and ( chunk_beg <= merged[-1][1] or chunk_beg[0] == merged[-1][1][0] ):
+            if chunk_end > merged[-1][1]:
+                merged[-1] = ( merged[-1][0], chunk_end )
+        else:
+            merged.append( ( chunk_beg, chunk_end ) )
+    return merged
+
+def reg2bins( beg, end ):
+    #calculate the list of bins that may overlap with region [beg,end) (zero-based)
+    bins = [0]
+    if beg >= end:
+        return bins
+    end -= 1 #last base in the region
+    for i in range( 1 + ( beg >> 26 ), 2 + ( end >> 26  ) ):
+        bins.append( i )
+    
+    for i in range( 9 + ( beg >> 23 ), 10 + ( end >> 23 ) ):
+        bins.append( i )
+    
+    for i in range( 73 + ( beg >> 20 ), 74 + ( end >> 20 ) ):
+        bins.append( i )
+    
+    for i in range( 585 + ( beg >> 17 ), 586 + ( end >> 17 ) ):
+        bins.append( i )
+    
+    for i in range( 4681 + ( beg >> 14 ), 4682 + ( end >> 14 ) ):
+        bins.append( i )
+    return bins
+
+def reg2bin( beg, end ):
+    #calculate bin given an alignment covering [beg,end) (zero-based, half-close-half-open)
+    end -= 1#end
+    if (beg>>14 == end>>14):
+        return ((1<<15)-1)/7 + (beg>>14)
+    if (beg>>17 == end>>17):
+        return ((1<<12)-1)/7 + (beg>>17)
+    if (beg>>20 == end>>20):
+        return ((1<<9)-1)/7 + (beg>>20)
+    if (beg>>23 == end>>23):
+        return ((1<<6)-1)/7 + (beg>>23)
+    if (beg>>26 == end>>26):
+        return ((1<<3)-1)/7 + (beg>>26)
+    return 0
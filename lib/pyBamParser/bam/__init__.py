@@ -1,11 +1,23 @@
 #Dan Blankenberg
+import threading
+from contextlib import contextmanager
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
 from ..bgzf import Reader as BGZFReader
-from ..bgzf import Reader as BGZFWriter
+from ..bgzf import MmapReader as BGZFMmapReader
+from ..bgzf import StreamReader as BGZFStreamReader
+from ..bgzf import Writer as BGZFWriter
 from ..bai import Reader as BAIReader
-from ..read import BAMRead
-from ..util import NULL_CHAR
+from ..bai import Writer as BAIWriter
+from ..bai import merge_chunks
+from ..read import BAMRead, BAM_READ_BEGIN_UNPACK_FROM, REFERENCE_CIGAR_OPS, get_end_position_from_data
+from ..util import NULL_CHAR, STANDARD_STREAM_FILENAME, is_seekable
 from ..util.odict import odict
-from ..util.packer import pack_int8, unpack_int8, pack_uint8, unpack_uint8, pack_int16, unpack_int16, pack_uint16, unpack_uint16, pack_int32, unpack_int32, pack_uint32, unpack_uint32, pack_int64, unpack_int64, pack_uint64, unpack_uint64
+from ..util.packer import pack_int8, unpack_int8, pack_uint8, unpack_uint8, pack_int16, unpack_int16, pack_uint16, unpack_uint16, pack_int32, unpack_int32, pack_uint32, unpack_uint32, pack_int64, unpack_int64, pack_uint64, unpack_uint64, unpack_int32_from
 
 BAM_MAGIC = 'BAM\x01'
 
@@ -15,47 +27,274 @@ SAM_READ_GROUP_ID_STR = 'ID'
 SAM_READ_GROUP_SAMPLE_STR = 'SM'
 SAM_NO_READ_GROUP_NAME = '__NONE__'
 
+#columns returned by Reader.next_batch(); offset is the packed virtual offset of the record
+BATCH_FIELDS = [ ( 'ref_id', 'int32' ), ( 'pos', 'int32' ), ( 'end', 'int32' ), ( 'flag', 'uint16' ), ( 'mapq', 'uint8' ), ( 'l_seq', 'int32' ),
+                 ( 'next_ref_id', 'int32' ), ( 'next_pos', 'int32' ), ( 't_len', 'int32' ), ( 'offset', 'int64' ) ]
+DEFAULT_BATCH_SIZE = 65536
+BAM_CORE_SIZE = 32 #bytes of fixed fields at the start of each record
+
+if numpy is not None:
+    #the fixed fields of a record, laid out as they are stored
+    BAM_CORE_DTYPE = numpy.dtype( [ ( 'ref_id', '<i4' ), ( 'pos', '<i4' ), ( 'l_read_name', 'u1' ), ( 'mapq', 'u1' ), ( 'bin', '<u2' ), ( 'n_cigar_op', '<u2' ), ( 'flag', '<u2' ),
+                                    ( 'l_seq', '<i4' ), ( 'next_ref_id', '<i4' ), ( 'next_pos', '<i4' ), ( 't_len', '<i4' ) ] )
+    REFERENCE_CIGAR_OP_MASK = numpy.array( [ op in REFERENCE_CIGAR_OPS for op in range( 16 ) ] )
+
+def decode_batch( records, offsets ):
+    #decodes the fixed fields and the cigar-derived end of a list of records, as next_raw() returns them, into the numpy columns of BATCH_FIELDS;
+    #the records are joined once and every field, and every cigar op, is gathered from that buffer by numpy, not unpacked record by record
+    n_records = len( records )
+    lengths = numpy.fromiter( ( len( data ) for data in records ), dtype=numpy.int64, count=n_records )
+    starts = numpy.cumsum( lengths ) - lengths
+    buffer = numpy.frombuffer( "".join( records ), dtype=numpy.uint8 )
+    core = buffer[ ( starts[ :, None ] + numpy.arange( BAM_CORE_SIZE ) ).ravel() ].view( BAM_CORE_DTYPE )
+    #end = pos + the reference length of the cigar ops
+    n_cigar_op = core['n_cigar_op'].astype( numpy.int64 )
+    op_record = numpy.repeat( numpy.arange( n_records ), n_cigar_op )
+    first_op = numpy.cumsum( n_cigar_op ) - n_cigar_op
+    op_starts = ( starts + BAM_CORE_SIZE + core['l_read_name'] )[ op_record ] + 4 * ( numpy.arange( len( op_record ) ) - first_op[ op_record ] )
+    ops = buffer[ ( op_starts[ :, None ] + numpy.arange( 4 ) ).ravel() ].view( '<u4' )
+    ref_lengths = numpy.where( REFERENCE_CIGAR_OP_MASK[ ops & 0x0f ], ops >> 4, 0 )
+    end = core['pos'] + numpy.bincount( op_record, weights=ref_lengths, minlength=n_records ).astype( numpy.int64 )
+    #records with their real cigar in the CG tag
+    two_ops = numpy.flatnonzero( n_cigar_op == 2 )
+    two_ops = two_ops[ ( ops[ first_op[ two_ops ] ] == ( core['l_seq'][ two_ops ].astype( numpy.int64 ) << 4 | 4 ) ) & ( ops[ first_op[ two_ops ] + 1 ] & 0x0f == 3 ) ]
+    for i in two_ops:
+        end[i] = get_end_position_from_data( records[i] )
+    columns = { 'end': end, 'offset': offsets }
+    for name, dtype in BATCH_FIELDS:
+        if name not in columns:
+            columns[ name ] = core[ name ]
+    return dict( ( name, numpy.ascontiguousarray( columns[ name ], dtype=dtype ) ) for name, dtype in BATCH_FIELDS )
+
+class RecordFilter( object ):
+    #accepts or rejects records on their fixed-length fields, before any BAMRead is built;
+    #predicate, if given, is called with the BAM_READ_BEGIN_UNPACK_FROM fields ( ref_id, pos, bin_mq_nl, flag_nc, l_seq, next_ref_id, next_pos, t_len )
+    def __init__( self, exclude_flags=0, require_flags=0, min_mapq=0, ref_ids=None, predicate=None ):
+        self.exclude_flags = exclude_flags
+        self.require_flags = require_flags
+        self.min_mapq = min_mapq
+        if ref_ids is not None:
+            ref_ids = frozenset( ref_ids )
+        self.ref_ids = ref_ids
+        self.predicate = predicate
+        self.passed = 0
+        self.skipped = 0
+    
+    def accept( self, fields ):
+        flag = fields[3] >> 16
+        if ( flag & self.exclude_flags or flag & self.require_flags != self.require_flags or fields[2] >> 8 & 0xff < self.min_mapq or
+             ( self.ref_ids is not None and fields[0] not in self.ref_ids ) or ( self.predicate is not None and not self.predicate( fields ) ) ):
+            self.skipped += 1
+            return False
+        self.passed += 1
+        return True
+    
+    def get_stats( self ):
+        return { 'passed': self.passed, 'skipped': self.skipped }
+
 class Reader( object ):
-    def __init__( self, filename, index_filename=None ):
-        self._bgzf_reader = BGZFReader( filename )
-        self._references_list = []
-        self._buffer = self._bgzf_reader.next()
+    def __init__( self, filename, index_filename=None, threads=None, use_mmap=False, cache_size=None, backend=None, record_filter=None ):
+        self._bgzf_kwds = bgzf_kwds = dict( threads=threads, cache_size=cache_size, backend=backend )
+        if filename == STANDARD_STREAM_FILENAME or not ( isinstance( filename, basestring ) or is_seekable( filename ) ):
+            #pipes, sockets and stdin are read as a stream, without an index
+            self._bgzf_reader = BGZFStreamReader( filename, **bgzf_kwds )
+        elif use_mmap:
+            self._bgzf_reader = BGZFMmapReader( filename, **bgzf_kwds )
+        else:
+            self._bgzf_reader = BGZFReader( filename, **bgzf_kwds )
+        #the current decompressed block, the read position within it and the block's file offset
+        self._buffer = ''
+        self._buffer_offset = 0
+        self._block_address = 0
+        self._next_block()
         self._read_groups = None
         magic = self.read( 4 )
         assert magic == BAM_MAGIC, "Bad BAM Magic (%s) in %s" % ( magic, self._filename )
         l_text = unpack_int32( self.read( 4 ) )[0]
         self._headers = self.read( l_text ).rstrip( NULL_CHAR )
-        n_ref = unpack_int32( self.read( 4 ) )[0]
-        for i in range( n_ref ):
+        self._sam_header_dict = None
+        self._sam_header_text = None
+        self._references_list = self._read_references( unpack_int32( self.read( 4 ) )[0] )
+        self._reference_ids = {}
+        for i, ( name, length ) in enumerate( self._references_list ):
+            self._reference_ids.setdefault( name, i ) #the first reference of a name wins, as with a scan
+        self._first_read_offset = self.tell_virtual()
+        self._bam_index = BAIReader( index_filename or "%s.bai" % self._filename, self )
+        self._record_filter = record_filter
+    
+    def _read_references( self, n_ref ):
+        #returns the ( name, length ) of n_ref references, unpacked in place from the current block where they fit
+        references = []
+        for i in xrange( n_ref ):
+            buffer = self._buffer
+            offset = self._buffer_offset + 4
+            if offset <= len( buffer ):
+                name_end = offset + unpack_int32_from( buffer, offset - 4 )[0]
+                if name_end + 4 <= len( buffer ):
+                    references.append( ( buffer[ offset:name_end ].rstrip( NULL_CHAR ), unpack_int32_from( buffer, name_end )[0] ) )
+                    self._buffer_offset = name_end + 4
+                    continue
             l_name = unpack_int32( self.read( 4 ) )[0]
             name = self.read( l_name ).rstrip( NULL_CHAR )
-            l_ref = unpack_int32( self.read( 4 ) )[0]
-            self._references_list.append( ( name, l_ref ) )
-        self._bam_index = BAIReader( index_filename or "%s.bai" % self._filename, self )
+            references.append( ( name, unpack_int32( self.read( 4 ) )[0] ) )
+        return references
+    
+    def clone( self, record_filter=None ):
+        #returns a Reader of the same file, positioned at the first read, with its own file handle and buffer but sharing the parsed header, references and BAM index;
+        #clones can be used from different threads
+        assert not isinstance( self._bgzf_reader, BGZFStreamReader ), Exception( "A BAM stream cannot be cloned." )
+        rval = object.__new__( self.__class__ )
+        rval.__dict__.update( self.__dict__ )
+        rval._bgzf_reader = self._bgzf_reader.__class__( self._filename, **self._bgzf_kwds )
+        rval._record_filter = record_filter
+        rval.rewind()
+        return rval
+    
+    def rewind( self ):
+        #go back to the first read
+        self.seek_virtual( self._first_read_offset )
     
     @property
     def _filename( self ):
         return self._bgzf_reader.filename
     
+    def _next_block( self ):
+        self._block_address = self._bgzf_reader.tell()
+        self._buffer = self._bgzf_reader.next()
+        self._buffer_offset = 0
+    
     def read( self, size ):
-        while len( self._buffer ) < size:
-            self._buffer += self._bgzf_reader.next()
-        data = self._buffer[ 0:size ]
-        self._buffer = self._buffer[ size: ]
-        return data
+        end = self._buffer_offset + size
+        if end <= len( self._buffer ):
+            data = self._buffer[ self._buffer_offset:end ]
+            self._buffer_offset = end
+            return data
+        #the data continues into the following block(s), collect the pieces and join them once
+        data = [ self._buffer[ self._buffer_offset: ] ]
+        size -= len( data[0] )
+        while True:
+            self._next_block()
+            if size <= len( self._buffer ):
+                data.append( self._buffer[ :size ] )
+                self._buffer_offset = size
+                return "".join( data )
+            data.append( self._buffer )
+            size -= len( self._buffer )
+    
+    def _read_record( self ):
+        #returns the next alignment record, without its block_size
+        buffer = self._buffer
+        offset = self._buffer_offset + 4
+        if offset <= len( buffer ):
+            end = offset + unpack_int32_from( buffer, offset - 4 )[ 0 ]
+            if end <= len( buffer ):
+                self._buffer_offset = end
+                return buffer[ offset:end ]
+        return self.read( unpack_int32( self.read( 4 ) )[ 0 ] )
+    
+    def tell_virtual( self ):
+        if self._buffer_offset >= len( self._buffer ):
+            #at the end of the current block, which is the same position as the start of the next one
+            return ( self._bgzf_reader.tell(), 0 )
+        return ( self._block_address, self._buffer_offset )
     
     def seek_virtual( self, offset_tuple ):
         file_offset, block_offset = offset_tuple
         self._bgzf_reader.seek( file_offset )
-        self._buffer = self._bgzf_reader.next()[block_offset:]
+        try:
+            self._next_block()
+        except StopIteration:
+            #at the end of the file, the next read will stop again
+            self._buffer = ''
+        self._buffer_offset = block_offset
     
     def next( self ):
-        block_size = unpack_int32( self.read( 4 ) )[ 0 ]
-        return BAMRead( self.read( block_size ), self )
+        return BAMRead( self.next_raw(), self )
+    
+    def next_raw( self ):
+        #returns the bytes of the next alignment record that passes the filter, without its block_size, for Writer.write_raw()
+        if self._record_filter is None:
+            return self._read_record()
+        accept = self._record_filter.accept
+        while True:
+            data = self._read_record()
+            if accept( BAM_READ_BEGIN_UNPACK_FROM( data ) ):
+                return data
+    
+    def set_filter( self, record_filter ):
+        #records rejected by record_filter are skipped by next(), fetch(), jump() and next_batch(); None removes the filter
+        self._record_filter = record_filter
+    
+    def get_filter_stats( self ):
+        if self._record_filter is None:
+            return None
+        return self._record_filter.get_stats()
     
     def __iter__( self ):
         return self
     
+    def next_batch( self, size=DEFAULT_BATCH_SIZE ):
+        #decodes the fixed fields of up to size records into a dict of numpy arrays named by BATCH_FIELDS, without creating BAMReads;
+        #returns None when there are no records left
+        if numpy is None:
+            raise ImportError( "numpy is required for next_batch()" )
+        accept = self._record_filter and self._record_filter.accept
+        records = []
+        offsets = []
+        while len( records ) < size:
+            #frame the records of the current block here, falling back to _read_record() for records that span blocks
+            buffer = self._buffer
+            buffer_offset = self._buffer_offset
+            block_address = self._block_address << 16
+            len_buffer = len( buffer )
+            while len( records ) < size and buffer_offset + 4 <= len_buffer:
+                end = buffer_offset + 4 + unpack_int32_from( buffer, buffer_offset )[0]
+                if end > len_buffer:
+                    break
+                data = buffer[ buffer_offset + 4:end ]
+                if not accept or accept( BAM_READ_BEGIN_UNPACK_FROM( data ) ):
+                    offsets.append( block_address | buffer_offset )
+                    records.append( data )
+                buffer_offset = end
+            self._buffer_offset = buffer_offset
+            if len( records ) >= size:
+                break
+            offset = self.tell_virtual()
+            try:
+                data = self._read_record()
+            except StopIteration:
+                break
+            if accept and not accept( BAM_READ_BEGIN_UNPACK_FROM( data ) ):
+                continue
+            offsets.append( offset[0] << 16 | offset[1] )
+            records.append( data )
+        if not records:
+            return None
+        return decode_batch( records, numpy.array( offsets, dtype=numpy.int64 ) )
+    
+    def iter_batches( self, size=DEFAULT_BATCH_SIZE ):
+        while True:
+            batch = self.next_batch( size )
+            if batch is None:
+                break
+            yield batch
+    
+    def get_read_at( self, virtual_offset ):
+        #returns the BAMRead at a virtual offset, as a ( file offset, block offset ) tuple or packed like the batch offsets, without moving the reader
+        if not isinstance( virtual_offset, tuple ):
+            virtual_offset = ( int( virtual_offset ) >> 16, int( virtual_offset ) & 0xFFFF )
+        position = self.tell_virtual()
+        self.seek_virtual( virtual_offset )
+        read = BAMRead( self._read_record(), self ) #not subject to the record filter
+        self.seek_virtual( position )
+        return read
+    
+    def close( self ):
+        self._bgzf_reader.close()
+    
+    def get_cache_stats( self ):
+        return self._bgzf_reader.get_cache_stats()
+    
     def get_references( self ):
         return self._references_list
     
@@ -66,10 +305,7 @@ class Reader( object ):
             return self._references_list[ ref_id ]
     
     def get_reference_id_by_name( self, name ):
-        for i, (ref_name, ref_len ) in enumerate( self._references_list ):
-            if name == ref_name:
-                return i
-        return None
+        return self._reference_ids.get( name, None )
     
     def get_reference_name_by_id( self, ref_id, other_id=None ):
         if ref_id < 0:
@@ -79,6 +315,12 @@ class Reader( object ):
         return self._references_list[ ref_id ][0]
     
     def get_sam_header_dict( self ):
+        #parsed once and shared between calls, do not modify the returned value
+        if self._sam_header_dict is None:
+            self._sam_header_dict = self._parse_sam_header()
+        return self._sam_header_dict
+    
+    def _parse_sam_header( self ):
         rval = odict()
         for line in self._headers.split( '\n' ):
             line = line.rstrip( '\r' )
@@ -115,22 +357,24 @@ class Reader( object ):
             seq_id = self.get_reference_id_by_name( seq_name )
         else:
             seq_id = seq_name  
-        if self._bam_index.jump_to_region( seq_id, start, start+1 ):
-            offset = self._bgzf_reader.tell()
-            buffer = self._buffer
-            read = self.next()
-            read_ref_id = read.get_reference_id()
-            while read_ref_id <= seq_id:
-                if read.get_end_position( one_based=False ) > start and read_ref_id == seq_id:
-                    break
+        chunks = self._bam_index.get_chunks( seq_id, start, start + 1 )
+        if chunks:
+            self.seek_virtual( chunks[0][0] ) #not bai.Reader.jump_to_region(), the index may be shared by clones
+            accept = self._record_filter and self._record_filter.accept
+            while True:
                 offset = self._bgzf_reader.tell()
-                buffer = self._buffer
-                read = self.next()
-                read_ref_id = read.get_reference_id()
+                buffer = ( self._buffer, self._buffer_offset, self._block_address )
+                data = self._read_record()
+                fields = BAM_READ_BEGIN_UNPACK_FROM( data )
+                read_ref_id = fields[0]
+                if read_ref_id < seq_id or ( read_ref_id == seq_id and get_end_position_from_data( data, fields ) <= start ):
+                    continue #ends before start, not offered to the filter
+                if not accept or accept( fields ):
+                    break
             if next:
-                return read
+                return BAMRead( data, self )
             self._bgzf_reader.seek( offset )
-            self._buffer = buffer
+            self._buffer, self._buffer_offset, self._block_address = buffer
             return True
         else:
             if next:
@@ -138,57 +382,306 @@ class Reader( object ):
             else:
                 return False
     
+    def _get_region( self, seq_name, start, end ):
+        #returns ( seq_id, start, end ) for a region, seq_id is None for unknown references
+        if isinstance( seq_name, basestring ):
+            seq_id = self.get_reference_id_by_name( seq_name )
+        else:
+            seq_id = seq_name
+        if seq_id is None or seq_id < 0 or seq_id >= len( self._references_list ):
+            return ( None, start, end )
+        if end is None:
+            end = self.get_reference_by_id( seq_id )[1]
+        return ( seq_id, start or 0, end )
+    
+    def _read_chunks( self, seq_id, chunks, start, end, filtered=True ):
+        #yields ( data, fields, zero-based end ) for the records of seq_id in the chunks that overlap [start,end), until records start at or after end;
+        #data is as next_raw() returns it and fields are its BAM_READ_BEGIN_UNPACK_FROM values; when filtered, the filter is offered only the overlapping records
+        accept = filtered and self._record_filter and self._record_filter.accept
+        for chunk_beg, chunk_end in chunks:
+            if self.tell_virtual() != chunk_beg:
+                self.seek_virtual( chunk_beg )
+            while self.tell_virtual() < chunk_end:
+                try:
+                    data = self._read_record()
+                except StopIteration:
+                    return
+                fields = BAM_READ_BEGIN_UNPACK_FROM( data )
+                if fields[0] != seq_id or fields[1] >= end:
+                    #reads are sorted, nothing further can overlap
+                    return
+                read_end = max( get_end_position_from_data( data, fields ), fields[1] + 1 )
+                if read_end <= start or ( accept and not accept( fields ) ):
+                    continue
+                yield data, fields, read_end
+    
+    def fetch_raw( self, seq_name, start=None, end=None ):
+        #yields the records overlapping the zero-based, half-open region [start,end) as next_raw() returns them, without building BAMReads
+        assert self._bam_index, Exception( "You must provide a valid BAM index in order to use fetch.")
+        seq_id, start, end = self._get_region( seq_name, start, end )
+        if seq_id is None:
+            return
+        for data, fields, read_end in self._read_chunks( seq_id, self._bam_index.get_chunks( seq_id, start, end ), start, end ):
+            yield data
+    
+    def count( self, seq_name, start=None, end=None ):
+        #the number of reads overlapping the zero-based, half-open region [start,end), read from the index chunks of the region
+        #decoding only the fixed fields and cigar of each record; a whole reference is counted from the index alone when it can be
+        assert self._bam_index, Exception( "You must provide a valid BAM index in order to use count.")
+        seq_id, region_start, region_end = self._get_region( seq_name, start, end )
+        if seq_id is None:
+            return 0
+        if start is None and end is None and self._record_filter is None:
+            n_mapped, n_unmapped = self._bam_index.get_reference_counts( seq_id )
+            if n_mapped is not None:
+                return n_mapped + n_unmapped
+        rval = 0
+        for data, fields, read_end in self._read_chunks( seq_id, self._bam_index.get_chunks( seq_id, region_start, region_end ), region_start, region_end ):
+            rval += 1
+        return rval
+    
+    def get_idxstats( self ):
+        #returns ( name, length, mapped, unmapped ) for each reference and ( '*', 0, 0, reads without a reference ), from the index alone, like samtools idxstats;
+        #counts are None for references that the index has no pseudo-bin for
+        assert self._bam_index, Exception( "You must provide a valid BAM index in order to use get_idxstats.")
+        rval = []
+        for seq_id, ( name, length ) in enumerate( self._references_list ):
+            rval.append( ( name, length ) + self._bam_index.get_reference_counts( seq_id ) )
+        rval.append( ( '*', 0, 0, self._bam_index.get_unaligned_count() ) )
+        return rval
+    
+    def fetch( self, seq_name, start=None, end=None ):
+        #yields the reads overlapping the zero-based, half-open region [start,end), reading only the index chunks that can hold them
+        for data in self.fetch_raw( seq_name, start, end ):
+            yield BAMRead( data, self )
+    
+    def fetch_many( self, regions ):
+        #yields ( read, [ indexes of the regions it overlaps ] ) for regions given as ( seq_name, start, end ), zero-based, half-open;
+        #the chunks of all regions on a reference are merged into one plan so that every read is decoded once, in file order
+        assert self._bam_index, Exception( "You must provide a valid BAM index in order to use fetch_many.")
+        by_reference = {}
+        for i, ( seq_name, start, end ) in enumerate( regions ):
+            seq_id, start, end = self._get_region( seq_name, start, end )
+            if seq_id is not None and start < end:
+                by_reference.setdefault( seq_id, [] ).append( ( start, end, i ) )
+        for seq_id in sorted( by_reference ):
+            seq_regions = sorted( by_reference[ seq_id ] )
+            chunks = []
+            for start, end, i in seq_regions:
+                chunks.extend( self._bam_index.get_chunks( seq_id, start, end ) )
+            first = 0 #regions before this one all end at or before the current read
+            accept = self._record_filter and self._record_filter.accept
+            for data, fields, read_end in self._read_chunks( seq_id, merge_chunks( chunks ), seq_regions[0][0], max( end for start, end, i in seq_regions ), filtered=False ):
+                pos = fields[1]
+                while first < len( seq_regions ) and seq_regions[ first ][1] <= pos:
+                    first += 1
+                overlaps = []
+                for j in xrange( first, len( seq_regions ) ):
+                    start, end, i = seq_regions[ j ]
+                    if start >= read_end:
+                        break
+                    if end > pos:
+                        overlaps.append( i )
+                if overlaps and ( not accept or accept( fields ) ):
+                    yield BAMRead( data, self ), sorted( overlaps )
+    
     def get_sam_header_text( self ):
+        if self._sam_header_text is None:
+            self._sam_header_text = self._build_sam_header_text()
+        return self._sam_header_text
+    
+    def _build_sam_header_text( self ):
+        #the header records, with an @SQ record for each reference that the header text does not list
         header_dict = self.get_sam_header_dict()
-        if '@SQ' not in header_dict:
-            header_dict.insert( 0, '@SQ', [] )
-        sq_in_dict = []
-        for sq in header_dict.get( '@SQ' ):
-            sq_in_dict.append( sq.get( 'SN' ) )
-        rval = ''
+        sq_records = list( header_dict.get( '@SQ', [] ) )
+        sq_in_dict = set( sq.get( 'SN' ) for sq in sq_records )
         for ref_name, ref_len in self._references_list:
             if ref_name not in sq_in_dict:
                 sn_dict = odict()
                 sn_dict['SN'] = ref_name #SN comes before LN by convention
                 sn_dict['LN'] = ref_len
-                header_dict[ '@SQ' ].append( sn_dict )
-        rval = ''
-        for rec_code, values in header_dict.iteritems():
+                sq_records.append( sn_dict )
+        records = header_dict.items()
+        if '@SQ' in header_dict:
+            records = [ ( rec_code, sq_records if rec_code == '@SQ' else values ) for rec_code, values in records ]
+        else:
+            records.insert( 0, ( '@SQ', sq_records ) )
+        lines = []
+        for rec_code, values in records:
             for value in values:
                 if rec_code in SAM_HEADER_NON_TAB_RECORDS:
-                    str_val = '\t' + value
+                    lines.append( "%s\t%s" % ( rec_code, value ) )
                 else:
-                    str_val = ''
-                    for tag, val in value.iteritems():
-                        str_val = "%s\t%s:%s" % ( str_val, tag, val )
-                rval = "%s%s%s\n" % ( rval, rec_code, str_val )
-        rval = rval.strip( '\n\r' )
+                    lines.append( "\t".join( [ rec_code ] + [ "%s:%s" % ( tag, val ) for tag, val in value.iteritems() ] ) )
         #TODO: add @PG header
-        return rval
+        return "\n".join( lines ).strip( '\n\r' )
+    
+    
+class ReaderPool( object ):
+    #hands out Reader clones, each with its own file handle and buffer, to threads;
+    #the header, references and BAM index are parsed once and shared by all of them
+    def __init__( self, filename, index_filename=None, max_readers=None, **reader_kwds ):
+        #checkout() blocks while max_readers readers are checked out
+        self._reader = Reader( filename, index_filename=index_filename, **reader_kwds )
+        assert not isinstance( self._reader._bgzf_reader, BGZFStreamReader ), Exception( "A BAM stream cannot be shared by a ReaderPool." )
+        #cache the parsed header on the template, so that every clone shares it
+        self._reader.get_sam_header_text()
+        self._reader.get_read_groups()
+        self._lock = threading.Lock()
+        self._idle_readers = []
+        self._created = 0
+        self._checked_out = 0
+        self._max_readers = max_readers
+        if max_readers:
+            self._available = threading.BoundedSemaphore( max_readers )
+        else:
+            self._available = None
+    
+    def checkout( self, record_filter=None ):
+        #returns a Reader for the calling thread alone, positioned at the first read; give it back with checkin()
+        if self._available is not None:
+            self._available.acquire()
+        with self._lock:
+            self._checked_out += 1
+            if self._idle_readers:
+                reader = self._idle_readers.pop()
+            else:
+                reader = None
+                self._created += 1
+        if reader is None:
+            try:
+                return self._reader.clone( record_filter=record_filter )
+            except:
+                #give back the slot, or the pool would block forever after max_readers failures
+                with self._lock:
+                    self._checked_out -= 1
+                    self._created -= 1
+                if self._available is not None:
+                    self._available.release()
+                raise
+        reader.set_filter( record_filter )
+        reader.rewind()
+        return reader
+    
+    def checkin( self, reader ):
+        with self._lock:
+            self._checked_out -= 1
+            self._idle_readers.append( reader )
+        if self._available is not None:
+            self._available.release()
+    
+    @contextmanager
+    def reader( self, record_filter=None ):
+        #with pool.reader() as reader: ...
+        reader = self.checkout( record_filter=record_filter )
+        try:
+            yield reader
+        finally:
+            self.checkin( reader )
     
+    def fetch( self, seq_name, start=None, end=None ):
+        #returns the list of reads overlapping the zero-based, half-open region
+        with self.reader() as reader:
+            return list( reader.fetch( seq_name, start, end ) )
+    
+    def get_references( self ):
+        return self._reader.get_references()
+    
+    def get_reference_id_by_name( self, name ):
+        return self._reader.get_reference_id_by_name( name )
+    
+    def get_sam_header_dict( self ):
+        return self._reader.get_sam_header_dict()
+    
+    def get_sam_header_text( self ):
+        return self._reader.get_sam_header_text()
+    
+    def get_read_groups( self ):
+        return self._reader.get_read_groups()
+    
+    def get_stats( self ):
+        with self._lock:
+            return { 'created': self._created, 'idle': len( self._idle_readers ), 'checked_out': self._checked_out, 'max_readers': self._max_readers }
+    
+    def close( self ):
+        with self._lock:
+            while self._idle_readers:
+                self._idle_readers.pop().close()
+        self._reader.close()
     
 class Writer( object ):
     
-    def __init__( self, filename, headers=None, references=None ):
-        self._writer = BGZFWriter( filename )
+    def __init__( self, filename, headers=None, references=None, threads=None, compress_level=6, backend=None, index=False, index_filename=None ):
+        self._writer = BGZFWriter( filename, compress_level=compress_level, threads=threads, backend=backend, track_block_offsets=index )
         self._headers = headers or ''
         self._references = references
-        bam_header = "%s%s%s%s" % (BAM_MAGIC, pack_int32( len( self._headers ) ), self._headers, pack_int32( "<i", len( self._references ) ) )
+        self._is_open = True
+        self._bam_index = None
+        if index:
+            #records must be written in coordinate order; the index is written on close()
+            self._bam_index = BAIWriter( len( self._references ) )
+            self._index_filename = index_filename or "%s.bai" % self._writer._filename
+        bam_header = [ BAM_MAGIC, pack_int32( len( self._headers ) ), self._headers, pack_int32( len( self._references ) ) ]
         for ref_name, ref_length in self._references:
-            bam_header = "%s%s%s%s%s" % ( bam_header, pack_int32( "<i", len( ref_name ) + 1 ), ref_name, NULL_CHAR, pack_int32( "<i", ref_length ) )
-        self._writer.write( bam_header )
+            bam_header.append( "%s%s%s%s" % ( pack_int32( len( ref_name ) + 1 ), ref_name, NULL_CHAR, pack_int32( ref_length ) ) )
+        self._writer.write( "".join( bam_header ) )
         self._writer.flush() #bam header will have its own bgzf blocks, increases speed for replacing header later
-        self._alignment_start_offset = self._writer._fh.tell() #alignment blocks start here, make it easy to replace header
+        self._alignment_start_offset = self._writer.tell() #alignment blocks start here, make it easy to replace header
     
     def write( self, read ):
         if isinstance( read, BAMRead ):
-            self._writer.write( read.get_bam_data() )
+            if self._bam_index is None:
+                self._writer.write( read.get_bam_data() )
+            else:
+                offset_beg = self._writer.tell_virtual()
+                self._writer.write( read.get_bam_data() )
+                self._index_read( read, offset_beg, self._writer.tell_virtual() )
         else:
             raise NotImplementedError( 'this write type is not implemented yet' )
+    
+    def write_raw( self, data ):
+        #writes an alignment record given as its bytes without the block_size, as returned by Reader.next_raw()
+        if self._bam_index is None:
+            self._writer.write( "%s%s" % ( pack_int32( len( data ) ), data ) )
+        else:
+            offset_beg = self._writer.tell_virtual()
+            self._writer.write( "%s%s" % ( pack_int32( len( data ) ), data ) )
+            self._index_raw( data, offset_beg, self._writer.tell_virtual() )
+    
+    def _index_raw( self, data, offset_beg, offset_end ):
+        fields = BAM_READ_BEGIN_UNPACK_FROM( data )
+        flag = fields[3] >> 16
+        pos = fields[1]
+        if flag & 0x4:
+            end = pos + 1
+        else:
+            end = get_end_position_from_data( data, fields )
+        self._bam_index.add( fields[0], pos, end, flag, offset_beg, offset_end )
+    
+    def _index_read( self, read, offset_beg, offset_end ):
+        flag = read.get_flag()
+        pos = read.get_position_zero_based()
+        if flag & 0x4:
+            end = pos + 1
+        else:
+            end = read.get_end_position( one_based=False )
+        self._bam_index.add( read.get_reference_id(), pos, end, flag, offset_beg, offset_end )
         
     def flush( self ):
         self._writer.flush()
         
     def close( self ):
-        self.flush()
-        self._writer.close()
+        if self._is_open:
+            self.flush()
+            self._writer.close()
+            self._is_open = False
+            if self._bam_index is not None:
+                self._bam_index.write( self._index_filename, self._writer.get_block_file_offset )
+                self._bam_index = None
+    
+    def abort( self ):
+        #closes the file without finishing it: no EOF marker and no index are written
+        if self._is_open:
+            self._writer.abort()
+            self._is_open = False
+            self._bam_index = None
@@ -0,0 +1,151 @@
+"""
+asyncio front end to bam.Reader.
+
+File reads and inflation run in an executor, each query on a Reader checked
+out of a ReaderPool, so that many region queries on the same BAM can be
+awaited concurrently while sharing its parsed header and BAM index. This module does
+not use async/await syntax: the methods return futures, and iterators
+implement __aiter__/__anext__ by hand. On Python 2, trollius is used in place
+of asyncio (the 'async' extra installs it); there is no async for there, so
+an iterator is driven by waiting on the futures __anext__() returns, with
+yield From( ... ) in a trollius coroutine or loop.run_until_complete().
+"""
+from collections import deque
+from itertools import islice
+
+try:
+    import asyncio
+except ImportError:
+    try:
+        import trollius as asyncio
+    except ImportError:
+        asyncio = None
+
+from . import ReaderPool
+
+try:
+    StopAsyncIteration = StopAsyncIteration
+except NameError:
+    class StopAsyncIteration( Exception ):
+        pass
+
+DEFAULT_ITER_BATCH_SIZE = 256 #reads decoded per trip to the executor while iterating
+
+def _fetch( reader, seq_name, start, end ):
+    return list( reader.fetch( seq_name, start, end ) )
+
+def _fetch_many( reader, regions ):
+    return list( reader.fetch_many( regions ) )
+
+def _jump( reader, seq_name, start, count ):
+    read = reader.jump( seq_name, start )
+    if read is None:
+        return []
+    reads = [ read ]
+    for read in islice( reader, count - 1 ):
+        reads.append( read )
+    return reads
+
+class AsyncReader( object ):
+    def __init__( self, filename, index_filename=None, loop=None, executor=None, max_readers=None, **reader_kwds ):
+        #executor=None uses the default executor of the loop; max_readers limits the open file handles, see ReaderPool
+        assert asyncio is not None, Exception( "asyncio (or trollius) is required to use the AsyncReader." )
+        self._pool = ReaderPool( filename, index_filename=index_filename, max_readers=max_readers, **reader_kwds )
+        self._loop = loop or asyncio.get_event_loop()
+        self._executor = executor
+    
+    def _call( self, func, args ):
+        with self._pool.reader() as reader:
+            return func( reader, *args )
+    
+    def run( self, func, *args ):
+        #returns a future for func( reader, *args ), called in the executor with a Reader that no other query is using
+        return self._loop.run_in_executor( self._executor, self._call, func, args )
+    
+    def fetch( self, seq_name, start=None, end=None ):
+        #future for the list of reads overlapping the zero-based, half-open region
+        return self.run( _fetch, seq_name, start, end )
+    
+    def fetch_many( self, regions ):
+        #future for the list of ( read, [ region indexes ] ) that Reader.fetch_many() yields
+        return self.run( _fetch_many, regions )
+    
+    def jump( self, seq_name, start, count=1 ):
+        #future for the list of the first read overlapping start and up to count - 1 reads following it
+        return self.run( _jump, seq_name, start, count )
+    
+    def iter_reads( self, seq_name=None, start=None, end=None, batch_size=DEFAULT_ITER_BATCH_SIZE ):
+        #async iterator over the reads of a region, or of the whole file when seq_name is None
+        return AsyncReadIterator( self, seq_name, start, end, batch_size )
+    
+    def __aiter__( self ):
+        return self.iter_reads()
+    
+    def get_pool( self ):
+        return self._pool
+    
+    def get_references( self ):
+        return self._pool.get_references()
+    
+    def get_reference_id_by_name( self, name ):
+        return self._pool.get_reference_id_by_name( name )
+    
+    def get_sam_header_text( self ):
+        return self._pool.get_sam_header_text()
+    
+    def close( self ):
+        self._pool.close()
+
+class AsyncReadIterator( object ):
+    #reads are decoded in batches in the executor and handed out one per __anext__()
+    def __init__( self, async_reader, seq_name, start, end, batch_size ):
+        self._async_reader = async_reader
+        self._region = ( seq_name, start, end )
+        self._batch_size = batch_size
+        self._reads = deque()
+        self._reader = None
+        self._iter = None
+        self._done = False
+    
+    def __aiter__( self ):
+        return self
+    
+    def __anext__( self ):
+        loop = self._async_reader._loop
+        if not self._reads and not self._done:
+            return loop.run_in_executor( self._async_reader._executor, self._next_batch )
+        future = asyncio.Future( loop=loop )
+        if self._reads:
+            future.set_result( self._reads.popleft() )
+        else:
+            future.set_exception( StopAsyncIteration() )
+        return future
+    
+    def _next_batch( self ):
+        #runs in the executor, returns the first read of the next batch and keeps the rest;
+        #the reader is checked back in at the end of the reads, or when reading them fails
+        done = True
+        try:
+            if self._iter is None:
+                self._reader = self._async_reader._pool.checkout()
+                seq_name, start, end = self._region
+                if seq_name is None:
+                    self._iter = iter( self._reader )
+                else:
+                    self._iter = self._reader.fetch( seq_name, start, end )
+            batch = list( islice( self._iter, self._batch_size ) )
+            done = len( batch ) < self._batch_size
+        finally:
+            if done:
+                self.close()
+        if not batch:
+            raise StopAsyncIteration()
+        self._reads.extend( batch[1:] )
+        return batch[0]
+    
+    def close( self ):
+        #stop iterating and return the reader, for iterators that are abandoned before the end
+        self._done = True
+        if self._reader is not None:
+            self._async_reader._pool.checkin( self._reader )
+            self._reader = None
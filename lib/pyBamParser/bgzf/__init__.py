@@ -3,9 +3,14 @@ import zlib
 import struct
 import sys
 import os.path
+import mmap
 import string
+from bisect import bisect_right
+from collections import deque
+from multiprocessing.pool import ThreadPool
 
-from ..util import get_filename_and_open
+from ..util import get_filename_and_open, STANDARD_STREAM_FILENAME
+from ..util.lru import LRUCache
 from ..util.packer import pack_int8, unpack_int8, pack_uint8, unpack_uint8, pack_int16, unpack_int16, pack_uint16, unpack_uint16, pack_int32, unpack_int32, pack_uint32, unpack_uint32, pack_int64, unpack_int64, pack_uint64, unpack_uint64
 
 MAX_NEG_INT = -sys.maxint
@@ -15,99 +20,578 @@ BGZF_MAGIC = '\x1f\x8b\x08\x04'
 BGZF_WRITE_HEADER = BGZF_MAGIC + '\x00\x00\x00\x00\x00\xff\x06\x00BC\x02\x00'
 BGZF_EOF = BGZF_WRITE_HEADER + '\x1b\x00\x03\x00\x00\x00\x00\x00\x00\x00\x00\x00'
 BGZF_MAX_BLOCK_SIZE = 2**16
+BGZF_BLOCK_SIZE = 0xff00 #uncompressed bytes per block written; the worst case deflate expansion of this many bytes still fits into BGZF_MAX_BLOCK_SIZE, so a block never has to be recompressed
 
 HEADER_BLOCK_SIZE = 25
 CRC_PYTHON_COMPATIBILITY = 0xffffffff
 
 MTIME_XFL_OS_XLEN_SI1_SI2_SLEN_BSIZE_UNPACKER = struct.Struct( "<IBBHBBHH" ).unpack
+MTIME_XFL_OS_XLEN_SI1_SI2_SLEN_BSIZE_UNPACK_FROM = struct.Struct( "<IBBHBBHH" ).unpack_from
+SI1_SI2_SLEN_UNPACK_FROM = struct.Struct( "<BBH" ).unpack_from
+CRC_ISIZE_UNPACK_FROM = struct.Struct( "<II" ).unpack_from
+GZI_ENTRY_PACKER = struct.Struct( "<QQ" ).pack
+GZI_ENTRY_UNPACKER = struct.Struct( "<QQ" ).unpack
+
+READ_AHEAD_BLOCKS_PER_THREAD = 4
+PENDING_BLOCKS_PER_THREAD = 4
+
+#deflate implementations with the zlib module interface, fastest first: ( name, module, highest compression level, lowest Python version );
+#the isal and zlib-ng packages only exist for Python 3, so on Python 2 they are skipped and zlib is always used
+DEFLATE_BACKENDS = [ ( 'isal', 'isal.isal_zlib', 3, ( 3, ) ), ( 'zlib-ng', 'zlib_ng.zlib_ng', 9, ( 3, ) ), ( 'zlib', 'zlib', 9, ( 2, ) ) ]
+
+class DeflateBackend( object ):
+    
+    def __init__( self, name, module, max_compress_level=9 ):
+        self.name = name
+        self._module = module
+        self._max_compress_level = max_compress_level
+    
+    def decompress( self, cdata ):
+        return self._module.decompress( cdata, WBITS ) #decompress the data, no headers
+    
+    def new_compressor( self, compress_level ):
+        return self._module.compressobj( min( compress_level, self._max_compress_level ), self._module.DEFLATED, WBITS, self._module.DEF_MEM_LEVEL, 0 )
+    
+    def crc32( self, data ):
+        return self._module.crc32( data ) & CRC_PYTHON_COMPATIBILITY #Note: To generate the same numeric value across all Python versions and platforms use crc32(data) & 0xffffffff. If you are only using the checksum in packed binary format this is not necessary as the return value is the correct 32bit binary representation regardless of sign.
+
+def get_deflate_backend( name=None ):
+    #name can be a backend name, a DeflateBackend, or None for the fastest importable backend
+    if isinstance( name, DeflateBackend ):
+        return name
+    for backend_name, module_name, max_compress_level, min_version in DEFLATE_BACKENDS:
+        if name is None or name == backend_name:
+            if sys.version_info < min_version:
+                if name is None:
+                    continue
+                raise ImportError( "The %s deflate backend requires Python %s." % ( name, ".".join( map( str, min_version ) ) ) )
+            try:
+                module = __import__( module_name, fromlist=[ 'decompress' ] )
+            except ImportError:
+                if name is None:
+                    continue
+                raise
+            return DeflateBackend( backend_name, module, max_compress_level )
+    raise ValueError( "Unknown deflate backend: %s" % ( name ) )
+
+def get_available_deflate_backends():
+    rval = []
+    for backend_name, module_name, max_compress_level, min_version in DEFLATE_BACKENDS:
+        try:
+            rval.append( get_deflate_backend( backend_name ) )
+        except ImportError:
+            pass
+    return rval
+
+def inflate( cdata, isize, backend ):
+    data = backend.decompress( cdata )
+    assert isize == len( data ), "Invalid decompressed data size"
+    return data
+
+def deflate( data, new_compressor, backend ):
+    #returns the complete BGZF block for data, which must be no longer than BGZF_BLOCK_SIZE
+    compressor = new_compressor()
+    compressed_data = compressor.compress( data ) + compressor.flush()
+    len_compressed = len( compressed_data )
+    assert HEADER_BLOCK_SIZE + len_compressed < BGZF_MAX_BLOCK_SIZE, "Compressed block is too large (%i bytes)" % ( len_compressed )
+    crc = pack_uint32( backend.crc32( data ) )
+    bsize = pack_uint16( HEADER_BLOCK_SIZE + len_compressed )
+    isize = pack_uint32( len( data ) )
+    return BGZF_WRITE_HEADER + bsize + compressed_data + crc + isize #FIXME: adjust BGZF_WRITE_HEADER for compression level?
+
+class BGZFFormatError( IOError ):
+    #data that is not a BGZF block where one should start
+    pass
+
+def get_bsize( extra, offset, xlen ):
+    #returns BSIZE from the BC subfield of the xlen bytes of gzip extra subfields at offset, or None when there is none;
+    #BGZF writers put BC first and alone, but other subfields are allowed around it
+    end = offset + xlen
+    while offset + 4 <= end:
+        si1, si2, slen = SI1_SI2_SLEN_UNPACK_FROM( extra, offset )
+        if si1 == 66 and si2 == 67 and slen == 2 and offset + 6 <= end:
+            return unpack_uint16( extra[ offset + 4:offset + 6 ] )[0]
+        offset += 4 + slen
+    return None
+
+def scan_blocks( filename, warn=True ):
+    #yields ( compressed offset, compressed size, uncompressed size ) for each block, reading only the block header and trailer and seeking over the compressed data;
+    #warn prints a warning when the last block is not the EOF marker
+    opened = isinstance( filename, basestring ) and filename != STANDARD_STREAM_FILENAME #handles given by the caller are left open
+    filename, fh = get_filename_and_open( filename, mode='rb' )
+    try:
+        offset = fh.tell()
+        block_info = None
+        while True:
+            header = fh.read( 18 )
+            if not header:
+                break
+            if header[:4] != BGZF_MAGIC[ :len( header ) ]:
+                #also for trailing data too short to be a block header, unless it could be the start of one
+                raise BGZFFormatError( "Bad BGZF magic at offset %i, are you sure this is a BGZF file (%s)?" % ( offset, filename ) )
+            if len( header ) < 18:
+                raise IOError( "Truncated BGZF block header at offset %i (%s)." % ( offset, filename ) )
+            mtime, xfl, OS, xlen, si1, si2, slen, bsize = MTIME_XFL_OS_XLEN_SI1_SI2_SLEN_BSIZE_UNPACK_FROM( header, 4 )
+            if xlen != 6 or si1 != 66 or si2 != 67:
+                extra = header[ 12: ] + fh.read( max( xlen - 6, 0 ) )
+                if len( extra ) < xlen:
+                    raise IOError( "Truncated BGZF block header at offset %i (%s)." % ( offset, filename ) )
+                bsize = get_bsize( extra, 0, xlen )
+                if bsize is None or xlen < 6:
+                    raise BGZFFormatError( "No BGZF block size subfield at offset %i, are you sure this is a BGZF file (%s)?" % ( offset, filename ) )
+            fh.seek( bsize - xlen - 19, 1 )
+            trailer = fh.read( 8 )
+            if len( trailer ) < 8:
+                raise IOError( "Truncated BGZF block at offset %i (%s)." % ( offset, filename ) )
+            crc, isize = CRC_ISIZE_UNPACK_FROM( trailer )
+            block_info = ( offset, bsize + 1, isize )
+            yield block_info
+            offset += bsize + 1
+        if warn and ( block_info is None or block_info[1:] != ( len( BGZF_EOF ), 0 ) ):
+            print >>sys.stderr, 'BGZF EOF marker was not found. Confirm that the BGZF file is not truncated.'
+    finally:
+        if opened:
+            fh.close()
+
+def get_block_stats( filename ):
+    #summarize the blocks of a BGZF file without inflating them;
+    #error_offset is the offset of the truncated or corrupt block the scan stopped at
+    rval = { 'blocks': 0, 'compressed_size': 0, 'uncompressed_size': 0, 'eof_marker': False, 'truncated': False, 'corrupt': False, 'error_offset': None }
+    last_block = None
+    try:
+        for last_block in scan_blocks( filename, warn=False ):
+            rval['blocks'] += 1
+            rval['compressed_size'] += last_block[1]
+            rval['uncompressed_size'] += last_block[2]
+    except BGZFFormatError:
+        rval['corrupt'] = True
+    except IOError:
+        rval['truncated'] = True
+    if rval['corrupt'] or rval['truncated']:
+        if last_block is None:
+            rval['error_offset'] = 0
+        else:
+            rval['error_offset'] = last_block[0] + last_block[1]
+    rval['eof_marker'] = last_block is not None and last_block[1:] == ( len( BGZF_EOF ), 0 ) and rval['error_offset'] is None
+    return rval
 
 class Reader( object ):
     
-    def __init__( self, filename ):
+    def __init__( self, filename, threads=None, read_ahead=None, cache_size=None, backend=None ):
+        self._pool = None
         self.filename, self.fh = get_filename_and_open( filename, mode='rb' )
+        self._backend = get_deflate_backend( backend )
+        self._threads = threads or 0
+        self._gzi_index = None
+        self._read_buffer = '' #uncompressed data for read()
+        self._read_offset = 0
+        self._cache = None
+        if cache_size:
+            #decompressed blocks keyed by file offset, bounded by cache_size bytes of decompressed data
+            self._cache = LRUCache( cache_size )
+        if self._threads:
+            #blocks are read from disk in order on the calling thread, but inflated by a pool of worker threads (the deflate backends release the GIL)
+            self._pool = ThreadPool( self._threads )
+            self._read_ahead = read_ahead or self._threads * READ_AHEAD_BLOCKS_PER_THREAD
+            self._pending = deque() #( offset, async result ) for blocks that have been read, in file order
+            self._stop = None #StopIteration, or IOError, to raise once the pending blocks have been handed out
     
     def seek( self, offset ):
-        return self.fh.seek( offset )
+        self._read_buffer = ''
+        self._read_offset = 0
+        if self._pool:
+            #keep any read-ahead from offset onwards, otherwise it is discarded and the worker results are simply dropped
+            while self._pending and self._pending[0][0] != offset:
+                self._pending.popleft()
+            if self._pending:
+                return
+            self._stop = None
+        return self._seek( offset )
     
     def tell( self ):
+        if self._pool and self._pending:
+            return self._pending[0][0]
+        return self._tell()
+    
+    def _seek( self, offset ):
+        return self.fh.seek( offset )
+    
+    def _tell( self ):
         return self.fh.tell()
     
+    def _check_eof( self ):
+        self.fh.seek( -28, 2 )
+        eof = self.fh.read( 28 )
+        if eof != BGZF_EOF:
+            print >>sys.stderr, 'BGZF EOF marker was not found. Confirm that the BGZF file is not truncated.'
+            return StopIteration( 'End of file, but BGZF EOF marker was not found. Confirm that the BGZF file is not truncated.' )
+        return StopIteration( 'End of file.' )
+    
+    def _truncated( self, offset ):
+        return IOError( "Truncated BGZF block at offset %i, the file or stream ends within the block (%s)." % ( offset, self.filename ) )
+    
+    def _no_bsize( self, offset ):
+        return BGZFFormatError( "No BGZF block size subfield at offset %i, are you sure this is a BGZF file (%s)?" % ( offset, self.filename ) )
+    
+    def _read_block( self ):
+        #returns the compressed data and expected uncompressed size of the next block, or None at the end of the file
+        offset = self._tell()
+        header = self.fh.read( 18 )
+        if not header:
+            return None
+        if header[:4] != BGZF_MAGIC[ :len( header ) ]:
+            raise BGZFFormatError( "Bad BGZF magic at offset %i, are you sure this is a BGZF file (%s)?" % ( offset, self.filename ) )
+        if len( header ) < 18:
+            raise self._truncated( offset )
+        mtime, xfl, OS, xlen, si1, si2, slen, bsize = MTIME_XFL_OS_XLEN_SI1_SI2_SLEN_BSIZE_UNPACK_FROM( header, 4 )
+        if xlen != 6 or si1 != 66 or si2 != 67:
+            extra = header[ 12: ] + self.fh.read( max( xlen - 6, 0 ) )
+            if len( extra ) < xlen:
+                raise self._truncated( offset )
+            bsize = get_bsize( extra, 0, xlen )
+            if bsize is None or xlen < 6:
+                raise self._no_bsize( offset )
+        self._block_size = bsize + 1
+        cdata_size = bsize - xlen - 19
+        cdata = self.fh.read( cdata_size ) #Compressed DATA by zlib::deflate() uint8 t[BSIZE-XLEN-19]
+        trailer = self.fh.read( 8 )
+        if len( cdata ) < cdata_size or len( trailer ) < 8:
+            raise self._truncated( offset )
+        crc, isize = CRC_ISIZE_UNPACK_FROM( trailer )
+        return cdata, isize
+    
     def next( self ):
-        magic = self.fh.read( 4 )
-        if magic:
-            assert magic == BGZF_MAGIC, "Bad BGZF magic, are you sure this is a BGZF file (%s)?" % ( self.filename )
-        else:
-            self.fh.seek( -28, 2 )
-            eof = self.fh.read( 28 )
-            if eof != BGZF_EOF:
-                print >>sys.stderr, 'BGZF EOF marker was not found. Confirm that the BGZF file is not truncated.'
-                raise StopIteration( 'End of file, but BGZF EOF marker was not found. Confirm that the BGZF file is not truncated.' )
-            raise StopIteration( 'End of file.' )
-        mtime, xfl, OS, xlen, si1, si2, slen, bsize = MTIME_XFL_OS_XLEN_SI1_SI2_SLEN_BSIZE_UNPACKER( self.fh.read( 14 ) )
-        cdata = self.fh.read( bsize - xlen - 19 ) #Compressed DATA by zlib::deflate() uint8 t[BSIZE-XLEN-19]
-        crc = unpack_uint32( self.fh.read( 4 ) )[0]
-        isize = unpack_uint32( self.fh.read( 4 ) )[0]
-        data = zlib.decompress( cdata, WBITS ) #decompress the data, no headers
-        assert isize == len( data ), "Invalid decompressed data size"
+        if self._cache is None:
+            return self._next()
+        offset = self.tell()
+        cached = self._cache.get( offset )
+        if cached is not None:
+            data, next_offset = cached
+            self.seek( next_offset )
+            return data
+        data = self._next()
+        self._cache.set( offset, ( data, self.tell() ), len( data ) )
         return data
+    
+    def read( self, size ):
+        #read size bytes of uncompressed data, continuing across blocks
+        rval = []
+        while size > 0:
+            if self._read_offset >= len( self._read_buffer ):
+                try:
+                    self._read_buffer = self.next()
+                except StopIteration:
+                    break
+                self._read_offset = 0
+                continue
+            data = self._read_buffer[ self._read_offset:self._read_offset + size ]
+            self._read_offset += len( data )
+            size -= len( data )
+            rval.append( data )
+        return "".join( rval )
+    
+    def build_gzi_index( self ):
+        index = GZIIndex()
+        uncompressed_offset = 0
+        for compressed_offset, compressed_size, isize in scan_blocks( self.filename ):
+            if isize and uncompressed_offset:
+                index.add( compressed_offset, uncompressed_offset )
+            uncompressed_offset += isize
+        self._gzi_index = index
+        return index
+    
+    def load_gzi_index( self, filename=None ):
+        self._gzi_index = GZIIndex( filename or "%s.gzi" % ( self.filename ) )
+        return self._gzi_index
+    
+    def get_gzi_index( self ):
+        if self._gzi_index is None:
+            self.build_gzi_index()
+        return self._gzi_index
+    
+    def seek_uncompressed( self, position ):
+        #position the reader so that read() returns data from the given uncompressed offset; returns the virtual offset
+        virtual_offset = self.get_gzi_index().get_virtual_offset( position )
+        self.seek( virtual_offset[0] )
+        try:
+            self._read_buffer = self.next()
+        except StopIteration:
+            self._read_buffer = ''
+        self._read_offset = virtual_offset[1]
+        return virtual_offset
+    
+    def get_cache_stats( self ):
+        if self._cache is None:
+            return None
+        return self._cache.get_stats()
+    
+    def _next( self ):
+        if self._pool:
+            return self._next_threaded()
+        block = self._read_block()
+        if block is None:
+            raise self._check_eof()
+        return inflate( block[0], block[1], self._backend )
+    
+    def _next_threaded( self ):
+        while self._stop is None and len( self._pending ) < self._read_ahead:
+            offset = self._tell()
+            try:
+                block = self._read_block()
+            except IOError, e:
+                #raised once the blocks before the bad one have been handed out
+                self._stop = e
+                break
+            if block is None:
+                self._stop = self._check_eof()
+                break
+            self._pending.append( ( offset, self._pool.apply_async( inflate, ( block[0], block[1], self._backend ) ) ) )
+        if not self._pending:
+            raise self._stop
+        return self._pending.popleft()[1].get()
+    
+    def _close_pool( self ):
+        if self._pool:
+            self._pool.terminate()
+            self._pool = None
+    
+    def close( self ):
+        self._close_pool()
+        self.fh.close()
+    
+    def __del__( self ):
+        self._close_pool()
+
+class MmapReader( Reader ):
+    #parses blocks in place from a read-only memory map of the file, instead of issuing several reads and copies per block
+    
+    def __init__( self, filename, **kwds ):
+        Reader.__init__( self, filename, **kwds )
+        self._offset = self.fh.tell()
+        self._mmap = mmap.mmap( self.fh.fileno(), 0, access=mmap.ACCESS_READ )
+        self._size = len( self._mmap )
+    
+    def _seek( self, offset ):
+        self._offset = offset
+    
+    def _tell( self ):
+        return self._offset
+    
+    def _check_eof( self ):
+        self._offset = self._size
+        if self._mmap[ -28: ] != BGZF_EOF:
+            print >>sys.stderr, 'BGZF EOF marker was not found. Confirm that the BGZF file is not truncated.'
+            return StopIteration( 'End of file, but BGZF EOF marker was not found. Confirm that the BGZF file is not truncated.' )
+        return StopIteration( 'End of file.' )
+    
+    def _read_block( self ):
+        offset = self._offset
+        if offset >= self._size:
+            return None
+        if self._mmap[ offset:offset + 4 ] != BGZF_MAGIC[ :self._size - offset ]:
+            raise BGZFFormatError( "Bad BGZF magic at offset %i, are you sure this is a BGZF file (%s)?" % ( offset, self.filename ) )
+        if offset + 18 > self._size:
+            raise self._truncated( offset )
+        mtime, xfl, OS, xlen, si1, si2, slen, bsize = MTIME_XFL_OS_XLEN_SI1_SI2_SLEN_BSIZE_UNPACK_FROM( self._mmap, offset + 4 )
+        if xlen != 6 or si1 != 66 or si2 != 67:
+            if offset + 12 + xlen > self._size:
+                raise self._truncated( offset )
+            bsize = get_bsize( self._mmap, offset + 12, xlen )
+            if bsize is None or xlen < 6:
+                raise self._no_bsize( offset )
+        if offset + bsize + 1 > self._size:
+            raise self._truncated( offset )
+        cdata_offset = offset + 12 + xlen
+        cdata_size = bsize - xlen - 19 #Compressed DATA by zlib::deflate() uint8 t[BSIZE-XLEN-19]
+        crc, isize = CRC_ISIZE_UNPACK_FROM( self._mmap, cdata_offset + cdata_size )
+        self._offset = offset + bsize + 1
+        return buffer( self._mmap, cdata_offset, cdata_size ), isize
+    
+    def close( self ):
+        self._close_pool()
+        self._mmap.close()
+        self.fh.close()
+
+class GZIIndex( object ):
+    #block table mapping compressed offsets to uncompressed offsets, as stored in .gzi files
+    
+    def __init__( self, filename=None ):
+        self._compressed_offsets = [ 0 ]
+        self._uncompressed_offsets = [ 0 ]
+        if filename:
+            self.load( filename )
+    
+    def __len__( self ):
+        return len( self._compressed_offsets )
+    
+    def add( self, compressed_offset, uncompressed_offset ):
+        #blocks must be added in file order
+        self._compressed_offsets.append( compressed_offset )
+        self._uncompressed_offsets.append( uncompressed_offset )
+    
+    def load( self, filename ):
+        fh = open( filename, 'rb' )
+        n_entries = unpack_uint64( fh.read( 8 ) )[0]
+        for i in xrange( n_entries ):
+            self.add( *GZI_ENTRY_UNPACKER( fh.read( 16 ) ) )
+        fh.close()
+    
+    def save( self, filename ):
+        #the first block, at ( 0, 0 ), is implicit
+        fh = open( filename, 'wb' )
+        fh.write( pack_uint64( len( self._compressed_offsets ) - 1 ) )
+        for entry in zip( self._compressed_offsets[1:], self._uncompressed_offsets[1:] ):
+            fh.write( GZI_ENTRY_PACKER( *entry ) )
+        fh.close()
+    
+    def get_virtual_offset( self, position ):
+        #returns ( compressed offset of the block containing position, offset within the uncompressed block )
+        i = bisect_right( self._uncompressed_offsets, position ) - 1
+        return ( self._compressed_offsets[i], position - self._uncompressed_offsets[i] )
+
+class StreamReader( Reader ):
+    #reads blocks from a non-seekable source such as a pipe or socket; the EOF marker is checked against the last block read
+    
+    def __init__( self, filename, **kwds ):
+        Reader.__init__( self, filename, **kwds )
+        self._offset = 0
+        self._last_block_is_eof = False
+    
+    def _seek( self, offset ):
+        if offset != self._offset:
+            raise IOError( "Cannot seek to %i in a BGZF stream at %i (%s)." % ( offset, self._offset, self.filename ) )
+    
+    def _tell( self ):
+        return self._offset
+    
+    def _check_eof( self ):
+        if not self._last_block_is_eof:
+            print >>sys.stderr, 'BGZF EOF marker was not found. Confirm that the BGZF stream is not truncated.'
+            return StopIteration( 'End of stream, but BGZF EOF marker was not found. Confirm that the BGZF stream is not truncated.' )
+        return StopIteration( 'End of stream.' )
+    
+    def _read_block( self ):
+        block = Reader._read_block( self )
+        if block is not None:
+            self._offset += self._block_size
+            self._last_block_is_eof = not block[1]
+        return block
 
 class Writer( object ):
     
-    def __init__( self, filename, compress_level=6 ):
+    def __init__( self, filename, compress_level=6, threads=None, max_pending=None, backend=None, track_block_offsets=False ):
+        self._pool = None
         self._filename, self._fh = get_filename_and_open( filename, mode='wb' )
         self._compress_level = compress_level
-        self._buffer = ''
+        self._backend = get_deflate_backend( backend )
+        self._chunks = [] #data waiting to be written, joined only once a block is complete
+        self._buffer_size = 0
         self._compressor = self._new_compressor()
         self._fh_is_open = True
-        self.get_new_compressor = self._compressor.copy #supposedly faster than creating a new one? But need to test
+        self._offset = 0 #compressed bytes written, so that non-seekable outputs can be used
+        self._block_count = 0 #blocks handed to the compressor so far
+        self._block_offsets = None
+        if track_block_offsets:
+            #file offset of every block written, so that block numbers from tell_virtual() can be resolved into real virtual offsets
+            self._block_offsets = []
+        self.get_new_compressor = getattr( self._compressor, 'copy', self._new_compressor ) #supposedly faster than creating a new one? But need to test
+        if threads:
+            #blocks are compressed by a pool of worker threads and written in order, with at most max_pending blocks in flight
+            self._pool = ThreadPool( threads )
+            self._max_pending = max_pending or threads * PENDING_BLOCKS_PER_THREAD
+            self._pending = deque()
     
     def _new_compressor( self ):
-        return zlib.compressobj( self._compress_level, zlib.DEFLATED, WBITS, zlib.DEF_MEM_LEVEL, 0 )
-    
-    def _write_buffer( self, block_size=None ):
-        if not block_size:
-            block_size = BGZF_MAX_BLOCK_SIZE
-        if len( self._buffer ) >= block_size:
-            data = self._buffer[:block_size]
-            self._buffer = self._buffer[block_size:]
-            len_data = block_size
+        return self._backend.new_compressor( self._compress_level )
+    
+    def _write_buffer( self, flush=False ):
+        #write out every complete block in the buffer, and the final partial block when flushing
+        data = "".join( self._chunks )
+        len_data = len( data )
+        offset = 0
+        while len_data - offset >= BGZF_BLOCK_SIZE or ( flush and offset < len_data ):
+            self._write_block( data[ offset:offset + BGZF_BLOCK_SIZE ] )
+            offset += BGZF_BLOCK_SIZE
+        if offset < len_data:
+            self._chunks = [ data[ offset: ] ]
+            self._buffer_size = len_data - offset
         else:
-            data = self._buffer
-            self._buffer = ''
-            len_data = len( data )
-        compressor = self.get_new_compressor()
-        compressed_data = compressor.compress( data ) + compressor.flush()
-        len_compressed = len( compressed_data )
-        if len_compressed > BGZF_MAX_BLOCK_SIZE:
-            #compressed too big, retry with half blocksize
-            del compressed_data
-            del len_compressed
-            del len_data
-            self._buffer = data + self._buffer
-            del data
-            return self._write_buffer( block_size = block_size/2 )
-        
-        crc = pack_uint32( zlib.crc32( data ) & CRC_PYTHON_COMPATIBILITY ) #Note: To generate the same numeric value across all Python versions and platforms use crc32(data) & 0xffffffff. If you are only using the checksum in packed binary format this is not necessary as the return value is the correct 32bit binary representation regardless of sign.
-        bsize = pack_uint16( HEADER_BLOCK_SIZE + len_compressed )
-        isize = pack_uint32( len_data )
-        self._fh.write( BGZF_WRITE_HEADER + bsize + compressed_data + crc + isize ) #FIXME: adjust BGZF_WRITE_HEADER for compression level?
+            self._chunks = []
+            self._buffer_size = 0
+    
+    def _write_block( self, data ):
+        self._block_count += 1
+        if self._pool:
+            while len( self._pending ) >= self._max_pending:
+                self._write( self._pending.popleft().get() )
+            self._pending.append( self._pool.apply_async( deflate, ( data, self.get_new_compressor, self._backend ) ) )
+        else:
+            self._write( deflate( data, self.get_new_compressor, self._backend ) )
+    
+    def _write_pending( self ):
+        if self._pool:
+            while self._pending:
+                self._write( self._pending.popleft().get() )
+    
+    def _write( self, block ):
+        if self._block_offsets is not None:
+            self._block_offsets.append( self._offset )
+        self._fh.write( block )
+        self._offset += len( block )
+    
+    def tell( self ):
+        #file offset following the blocks written so far; after flush() this is where the next block will start
+        return self._offset
+    
+    def tell_virtual( self ):
+        #( block number, offset within the uncompressed block ) for the next byte written; the block's file offset may not be known until it has been compressed
+        return ( self._block_count, self._buffer_size )
+    
+    def get_block_file_offset( self, block_number ):
+        #file offset of a block that has been written, requires track_block_offsets; the block after the last data block is the EOF marker
+        return self._block_offsets[ block_number ]
         
     def write( self, data ):
-        self._buffer += data
-        if len( self._buffer ) >= BGZF_MAX_BLOCK_SIZE:
-            return self._write_buffer()
+        self._chunks.append( data )
+        self._buffer_size += len( data )
+        if self._buffer_size >= BGZF_BLOCK_SIZE:
+            self._write_buffer()
+    
+    def write_many( self, iterable ):
+        chunks = self._chunks
+        for data in iterable:
+            chunks.append( data )
+            self._buffer_size += len( data )
+            if self._buffer_size >= BGZF_BLOCK_SIZE:
+                self._write_buffer()
+                chunks = self._chunks
     
     def flush( self ):
-        while self._buffer:
-            self._write_buffer()
+        if self._chunks:
+            self._write_buffer( flush=True )
+        self._write_pending()
         self._fh.flush()
             
     def close( self ):
         if self._fh_is_open:
             self.flush()
-            self._fh.write( BGZF_EOF )
+            self._write( BGZF_EOF )
+            self._fh.close()
+            self._fh_is_open = False
+        if self._pool:
+            self._pool.terminate()
+            self._pool = None
+        
+    def abort( self ):
+        #closes the file without writing the buffered data or the EOF marker, for output that is being thrown away
+        if self._fh_is_open:
+            self._chunks = []
+            self._buffer_size = 0
             self._fh.close()
             self._fh_is_open = False
+        if self._pool:
+            self._pool.terminate()
+            self._pool = None
         
     def __del__( self ):
         self.close() #need to close file, so that EOF is written
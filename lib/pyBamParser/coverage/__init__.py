@@ -0,0 +1,213 @@
+"""
+Read depth computed with NumPy difference arrays.
+
+Each record contributes the reference intervals of its aligned blocks, read
+straight from the cigar of the raw record without building a BAMRead; depth
+is the cumulative sum of +1 at block starts and -1 at block ends. D and N move
+along the reference, D is counted when count_deletions is set and N never is;
+H does not move along it, as in samtools, unlike in BAMRead.get_end_position().
+Records without SEQ or QUAL have all their bases counted whatever
+min_base_quality is.
+"""
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+from ..read import BAMRead, BAM_READ_BEGIN_UNPACK_FROM, DEFAULT_EXCLUDE_FLAGS, get_cigar_unpack_from
+
+DEFAULT_WINDOW_SIZE = 2**20 #bases of depth held in memory by iter_bedgraph()
+
+def get_aligned_blocks( data, fields=None, min_base_quality=0, count_deletions=False ):
+    #returns the zero-based, half-open ( start, end ) reference intervals covered by a record's aligned bases,
+    #leaving out bases with quality below min_base_quality
+    if fields is None:
+        fields = BAM_READ_BEGIN_UNPACK_FROM( data )
+    pos = fields[1]
+    n_cigar_op = fields[3] & 0xffff
+    cigar_offset = 32 + ( fields[2] & 0xff )
+    qual_offset = cigar_offset + 4 * n_cigar_op + ( fields[4] + 1 ) / 2
+    cigar = get_cigar_unpack_from( n_cigar_op )( data, cigar_offset )
+    if n_cigar_op == 2 and cigar[0] == ( fields[4] << 4 | 4 ) and cigar[1] & 0x0f == 3:
+        #the real cigar is stored in the CG tag
+        cigar = [ op_len << 4 | op for op_len, op in BAMRead( data, None ).get_cigar() ]
+    if min_base_quality and ( not fields[4] or data[ qual_offset ] == '\xff' ):
+        min_base_quality = 0 #no SEQ, or no QUAL, to filter on
+    min_qual = chr( min_base_quality )
+    blocks = []
+    query_offset = 0
+    for op in cigar:
+        op_len = op >> 4
+        op &= 0x0f
+        if op == 0 or op == 7 or op == 8: #M = X
+            if min_base_quality and op_len:
+                quals = data[ qual_offset + query_offset:qual_offset + query_offset + op_len ]
+                if min( quals ) < min_qual:
+                    blocks.extend( _split_block_by_quality( pos, quals, min_base_quality ) )
+                else:
+                    blocks.append( ( pos, pos + op_len ) )
+            else:
+                blocks.append( ( pos, pos + op_len ) )
+            pos += op_len
+            query_offset += op_len
+        elif op == 1 or op == 4: #I S
+            query_offset += op_len
+        elif op == 2: #D
+            if count_deletions:
+                blocks.append( ( pos, pos + op_len ) )
+            pos += op_len
+        elif op == 3: #N
+            pos += op_len
+    return blocks
+
+def _split_block_by_quality( pos, quals, min_base_quality ):
+    #the runs of bases in quals with quality of at least min_base_quality
+    passed = numpy.zeros( len( quals ) + 2, dtype=numpy.int8 )
+    passed[ 1:-1 ] = numpy.frombuffer( quals, dtype=numpy.uint8 ) >= min_base_quality
+    edges = numpy.flatnonzero( numpy.diff( passed ) )
+    return [ ( pos + int( run_start ), pos + int( run_end ) ) for run_start, run_end in zip( edges[::2], edges[1::2] ) ]
+
+def _iter_records( records, exclude_flags, min_mapq ):
+    #yields ( data, fields ) of the records passing the flag and MAPQ filters
+    for data in records:
+        fields = BAM_READ_BEGIN_UNPACK_FROM( data )
+        if fields[3] >> 16 & exclude_flags or fields[2] >> 8 & 0xff < min_mapq:
+            continue
+        yield data, fields
+
+def _iter_reader_records( bam_reader ):
+    while True:
+        try:
+            yield bam_reader.next_raw()
+        except StopIteration:
+            break
+
+def get_depth_from_blocks( starts, ends, start, end ):
+    #per base depth over [start,end) of the blocks given as arrays of starts and ends
+    length = end - start
+    starts = numpy.clip( numpy.asarray( starts, dtype=numpy.int64 ), start, end ) - start
+    ends = numpy.clip( numpy.asarray( ends, dtype=numpy.int64 ), start, end ) - start
+    #one int32 buffer holds the +1/-1 differences and then, summed in place, the depth
+    diff = numpy.zeros( length + 1, dtype=numpy.int32 )
+    numpy.add.at( diff, starts, 1 )
+    numpy.add.at( diff, ends, -1 )
+    depth = diff[ :length ]
+    numpy.cumsum( depth, out=depth )
+    return depth
+
+def get_depth( bam_reader, seq_name, start=None, end=None, exclude_flags=DEFAULT_EXCLUDE_FLAGS, min_mapq=0, min_base_quality=0, count_deletions=False ):
+    #returns the depth at each position of the zero-based, half-open region [start,end) of a reference, as a numpy int32 array;
+    #indexed readers only read the chunks of the region, others are read from their current position to the end
+    if numpy is None:
+        raise ImportError( "numpy is required for get_depth()" )
+    seq_id, start, end = bam_reader._get_region( seq_name, start, end )
+    if seq_id is None:
+        raise ValueError( "Unknown reference: %s" % ( seq_name ) )
+    if bam_reader._bam_index:
+        records = bam_reader.fetch_raw( seq_id, start, end )
+    else:
+        records = _iter_reader_records( bam_reader )
+    starts = []
+    ends = []
+    for data, fields in _iter_records( records, exclude_flags, min_mapq ):
+        if fields[0] != seq_id:
+            continue
+        for block_start, block_end in get_aligned_blocks( data, fields, min_base_quality, count_deletions ):
+            starts.append( block_start )
+            ends.append( block_end )
+    return get_depth_from_blocks( starts, ends, start, end )
+
+class _BedGraphRuns( object ):
+    #accumulates the blocks of one reference, in order of their starts, and turns them into depth runs a window at a time
+    def __init__( self, ref_name, ref_length, window_size, include_zero ):
+        self._ref_name = ref_name
+        self._ref_length = ref_length
+        self._window_size = window_size
+        self._include_zero = include_zero
+        self._window_start = 0
+        self._starts = []
+        self._ends = []
+        self._run = None #the last run, which can continue into the next window
+    
+    def add( self, block_start, block_end ):
+        self._starts.append( block_start )
+        self._ends.append( block_end )
+    
+    def flush( self, pos ):
+        #yields the finished runs of the windows that end at or before pos
+        limit = min( pos, self._ref_length )
+        while self._window_start + self._window_size <= limit:
+            for run in self._flush_window( limit ):
+                yield run
+    
+    def finish( self ):
+        while self._window_start < self._ref_length:
+            for run in self._flush_window( self._ref_length ):
+                yield run
+        if self._run is not None and ( self._run[3] or self._include_zero ):
+            yield self._run
+        self._run = None
+    
+    def _flush_window( self, limit ):
+        #with no blocks held, the bases up to limit are all zero depth and are passed over as one window
+        window_start = self._window_start
+        window_end = min( window_start + self._window_size, self._ref_length )
+        if self._starts:
+            starts = numpy.array( self._starts, dtype=numpy.int64 )
+            ends = numpy.array( self._ends, dtype=numpy.int64 )
+            depth = get_depth_from_blocks( starts, ends, window_start, window_end )
+            #blocks reaching past the window carry over, starting at the next window
+            carry = ends > window_end
+            self._starts = numpy.maximum( starts[ carry ], window_end ).tolist()
+            self._ends = ends[ carry ].tolist()
+            changes = numpy.flatnonzero( depth[ 1: ] != depth[ :-1 ] ) + 1
+            bounds = [ 0 ] + changes.tolist() + [ window_end - window_start ]
+            runs = [ ( window_start + run_start, window_start + run_end, int( depth[ run_start ] ) ) for run_start, run_end in zip( bounds[:-1], bounds[1:] ) ]
+        else:
+            window_end = limit
+            runs = [ ( window_start, window_end, 0 ) ]
+        self._window_start = window_end
+        for run_start, run_end, value in runs:
+            if self._run is not None and self._run[3] == value:
+                self._run = ( self._ref_name, self._run[1], run_end, value )
+                continue
+            if self._run is not None and ( self._run[3] or self._include_zero ):
+                yield self._run
+            self._run = ( self._ref_name, run_start, run_end, value )
+
+def iter_bedgraph( bam_reader, exclude_flags=DEFAULT_EXCLUDE_FLAGS, min_mapq=0, min_base_quality=0, count_deletions=False, include_zero=False, window_size=DEFAULT_WINDOW_SIZE ):
+    #yields ( ref_name, start, end, depth ) runs of equal depth over every reference of a coordinate sorted BAM, zero-based, half-open;
+    #reads from the first read, holding the depth of window_size bases at a time
+    if numpy is None:
+        raise ImportError( "numpy is required for iter_bedgraph()" )
+    references = bam_reader.get_references()
+    bam_reader.rewind()
+    runs = None
+    ref_id = -1
+    for data, fields in _iter_records( _iter_reader_records( bam_reader ), exclude_flags, min_mapq ):
+        if fields[0] < 0:
+            break #unplaced reads are last
+        while fields[0] != ref_id:
+            assert fields[0] > ref_id, "Reads must be coordinate sorted for a bedGraph (reference %i after %i)." % ( fields[0], ref_id )
+            if runs is not None:
+                for run in runs.finish():
+                    yield run
+            ref_id += 1
+            runs = _BedGraphRuns( references[ ref_id ][0], references[ ref_id ][1], window_size, include_zero )
+        for run in runs.flush( fields[1] ):
+            yield run
+        for block_start, block_end in get_aligned_blocks( data, fields, min_base_quality, count_deletions ):
+            runs.add( block_start, block_end )
+    while True:
+        if runs is not None:
+            for run in runs.finish():
+                yield run
+        ref_id += 1
+        if ref_id >= len( references ) or not include_zero:
+            break
+        runs = _BedGraphRuns( references[ ref_id ][0], references[ ref_id ][1], window_size, include_zero )
+
+def write_bedgraph( bam_reader, fh, **kwds ):
+    #writes iter_bedgraph() runs as bedGraph lines to an open file
+    for ref_name, start, end, depth in iter_bedgraph( bam_reader, **kwds ):
+        fh.write( "%s\t%i\t%i\t%i\n" % ( ref_name, start, end, depth ) )
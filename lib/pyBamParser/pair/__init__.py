@@ -0,0 +1,217 @@
+"""
+Streaming mate pairing for coordinate sorted reads, in bounded memory.
+
+A read waits for its mate only until the reads pass the mate's position
+(RNEXT, PNEXT); if the mate has not arrived by then it never will, and the
+read is released as an orphan. When more than max_pending reads are waiting,
+the read whose mate is farthest away is spilled to a temporary file, or
+released as an orphan when spilling is disabled. Spilled reads are found by
+name through an SQLite table next to the spill file, so that memory stays
+bounded by max_pending however many reads are spilled; those whose mates never
+arrive are released as orphans at the end, in the order they were spilled.
+"""
+import heapq
+import os
+import shutil
+import sqlite3
+import tempfile
+
+from ..read import BAMRead
+from ..util.packer import unpack_int32
+
+DEFAULT_MAX_PENDING = 1000000 #reads held in memory while waiting for their mates
+SKIP_FLAGS = 0x100 | 0x800 #secondary and supplementary alignments are not paired
+
+def get_sort_key( ref_id, pos ):
+    #coordinate sort order, with reads without a reference (-1) last
+    return ( ref_id & 0xffffffff, pos )
+
+class MatePairer( object ):
+    def __init__( self, reads, max_pending=DEFAULT_MAX_PENDING, spill=True, spill_dir=None, yield_orphans=False ):
+        #reads must be coordinate sorted BAMReads; yields ( read1, read2 ), first in pair first,
+        #and ( read, None ) for reads whose mate is missing when yield_orphans is set
+        self._reads = reads
+        self._max_pending = max_pending
+        self._spill = spill
+        self._spill_dir = spill_dir
+        self._yield_orphans = yield_orphans
+        self._pending = {} #name -> ( read, mate key )
+        self._spill_dir_created = None #temporary directory of the spill file and of the name table
+        self._spill_fh = None
+        self._spill_names = None #SQLite table of name -> ( file offset, mate key, reader index ) of the spilled reads still waiting
+        self._spill_readers = [] #the readers of the spilled reads, usually just one
+        self._n_spilled = 0
+        self._by_mate_key = [] #( mate key, name ) heap, nearest first, for expiry
+        self._by_distance = [] #( negated mate key, name ) heap, farthest first, for eviction
+        self.pairs = 0
+        self.orphans = 0
+        self.skipped = 0
+        self.spilled = 0
+        self.evicted = 0
+        self.max_pending_seen = 0
+    
+    def __iter__( self ):
+        return self._iter_pairs()
+    
+    def get_stats( self ):
+        return { 'pairs': self.pairs, 'orphans': self.orphans, 'skipped': self.skipped, 'pending': len( self._pending ), 'spilled_pending': self._n_spilled,
+                 'max_pending': self.max_pending_seen, 'spilled': self.spilled, 'evicted': self.evicted }
+    
+    def _pair( self, read, mate ):
+        self.pairs += 1
+        if mate.get_flag() & 0x40:
+            return ( mate, read )
+        return ( read, mate )
+    
+    def _take( self, name, key=None ):
+        #removes and returns the read waiting under name, from memory or the spill file, or None;
+        #a spilled read is only taken while the reads, at key, have not passed its mate's position
+        pending = self._pending.pop( name, None )
+        if pending is not None:
+            return pending[0]
+        if self._n_spilled:
+            row = self._spill_names.execute( "SELECT offset, ref_id, pos, reader FROM spilled WHERE name = ?", ( buffer( name ), ) ).fetchone()
+            if row is not None and ( key is None or ( row[1], row[2] ) >= key ):
+                self._spill_names.execute( "DELETE FROM spilled WHERE name = ?", ( buffer( name ), ) )
+                self._n_spilled -= 1
+                return self._read_spilled( row[0], row[3] )
+        return None
+    
+    def _read_spilled( self, offset, reader_index ):
+        self._spill_fh.seek( offset )
+        return BAMRead( self._spill_fh.read( unpack_int32( self._spill_fh.read( 4 ) )[0] ), self._spill_readers[ reader_index ] )
+    
+    def _expire( self, key ):
+        #yields the pending reads whose mates should have been seen before key
+        by_mate_key = self._by_mate_key
+        pending = self._pending
+        while by_mate_key and by_mate_key[0][0] < key:
+            mate_key, name = heapq.heappop( by_mate_key )
+            entry = pending.get( name )
+            if entry is not None and entry[1] == mate_key:
+                yield self._take( name )
+    
+    def _open_spill( self ):
+        self._spill_dir_created = tempfile.mkdtemp( prefix='pyBamParser_pairs_', dir=self._spill_dir )
+        self._spill_fh = open( os.path.join( self._spill_dir_created, 'reads' ), 'w+b' )
+        self._spill_names = sqlite3.connect( os.path.join( self._spill_dir_created, 'names.sqlite' ), isolation_level=None )
+        self._spill_names.execute( "PRAGMA journal_mode = OFF" )
+        self._spill_names.execute( "PRAGMA synchronous = OFF" )
+        self._spill_names.execute( "CREATE TABLE spilled ( name BLOB PRIMARY KEY, offset INTEGER, ref_id INTEGER, pos INTEGER, reader INTEGER )" )
+    
+    def _close_spill( self ):
+        if self._spill_fh is not None:
+            self._spill_names.close()
+            self._spill_fh.close()
+            shutil.rmtree( self._spill_dir_created, ignore_errors=True )
+            self._spill_names = None
+            self._spill_fh = None
+            self._n_spilled = 0
+    
+    def _evict( self ):
+        #makes room by removing the pending read whose mate is farthest away
+        while self._by_distance:
+            negated_key, name = heapq.heappop( self._by_distance )
+            entry = self._pending.get( name )
+            if entry is None or entry[1] != ( -negated_key[0], -negated_key[1] ):
+                continue #already paired or expired
+            read, mate_key = self._pending.pop( name )
+            if not self._spill:
+                self.evicted += 1
+                return read
+            if self._spill_fh is None:
+                self._open_spill()
+            for reader_index, reader in enumerate( self._spill_readers ):
+                if reader is read._reader:
+                    break
+            else:
+                reader_index = len( self._spill_readers )
+                self._spill_readers.append( read._reader )
+            self._spill_fh.seek( 0, 2 )
+            self._spill_names.execute( "INSERT OR REPLACE INTO spilled VALUES ( ?, ?, ?, ?, ? )", ( buffer( name ), self._spill_fh.tell(), mate_key[0], mate_key[1], reader_index ) )
+            self._n_spilled += 1
+            self._spill_fh.write( read.get_bam_data() )
+            self.spilled += 1
+            return None
+        return None
+    
+    def _iter_spilled( self ):
+        #removes and yields the spilled reads still waiting, in the order they were spilled
+        offset = 0
+        while self._n_spilled:
+            self._spill_fh.seek( offset )
+            block_size = unpack_int32( self._spill_fh.read( 4 ) )[0]
+            read = BAMRead( self._spill_fh.read( block_size ), None )
+            row = self._spill_names.execute( "SELECT offset, reader FROM spilled WHERE name = ?", ( buffer( read.get_read_name() ), ) ).fetchone()
+            if row is not None and row[0] == offset:
+                self._spill_names.execute( "DELETE FROM spilled WHERE name = ?", ( buffer( read.get_read_name() ), ) )
+                self._n_spilled -= 1
+                read._reader = self._spill_readers[ row[1] ]
+                yield read
+            offset += 4 + block_size
+    
+    def _orphan( self, read ):
+        self.orphans += 1
+        if self._yield_orphans:
+            return ( read, None )
+        return None
+    
+    def _iter_pairs( self ):
+        pending = self._pending
+        for read in self._reads:
+            flag = read.get_flag()
+            if not flag & 0x1 or flag & SKIP_FLAGS:
+                self.skipped += 1
+                continue
+            key = get_sort_key( read.get_reference_id(), read.get_position_zero_based() )
+            for orphan in self._expire( key ):
+                orphan = self._orphan( orphan )
+                if orphan:
+                    yield orphan
+            name = read.get_read_name()
+            mate = self._take( name, key )
+            if mate is not None:
+                yield self._pair( read, mate )
+                continue
+            mate_key = get_sort_key( read.get_rnext_id(), read.get_pnext( one_based=False ) )
+            if mate_key < key:
+                #the mate's position has been passed without it
+                orphan = self._orphan( read )
+                if orphan:
+                    yield orphan
+                continue
+            pending[ name ] = ( read, mate_key )
+            heapq.heappush( self._by_mate_key, ( mate_key, name ) )
+            heapq.heappush( self._by_distance, ( ( -mate_key[0], -mate_key[1] ), name ) )
+            if len( self._by_mate_key ) > 2 * len( pending ) + 1024:
+                #drop the entries of reads no longer pending, paired, evicted or spilled, which would otherwise accumulate
+                self._by_mate_key = [ entry for entry in self._by_mate_key if pending.get( entry[1], ( None, None ) )[1] == entry[0] ]
+                heapq.heapify( self._by_mate_key )
+            if len( self._by_distance ) > 2 * len( pending ) + 1024:
+                self._by_distance = [ entry for entry in self._by_distance if pending.get( entry[1], ( None, None ) )[1] == ( -entry[0][0], -entry[0][1] ) ]
+                heapq.heapify( self._by_distance )
+            if len( pending ) > self._max_pending:
+                evicted = self._evict()
+                if evicted is not None:
+                    evicted = self._orphan( evicted )
+                    if evicted:
+                        yield evicted
+            if len( pending ) > self.max_pending_seen:
+                self.max_pending_seen = len( pending )
+        #whatever is still waiting has no mate
+        for name in sorted( pending, key=lambda name: pending[ name ][1] ):
+            orphan = self._orphan( self._take( name ) )
+            if orphan:
+                yield orphan
+        if self._spill_fh is not None:
+            try:
+                for read in self._iter_spilled():
+                    orphan = self._orphan( read )
+                    if orphan:
+                        yield orphan
+            finally:
+                self._close_spill()
+
+def iter_pairs( reads, **kwds ):
+    #yields ( read1, read2 ) mate pairs from coordinate sorted reads, see MatePairer
+    return iter( MatePairer( reads, **kwds ) )
@@ -0,0 +1,67 @@
+"""
+Run a function over the reads of an indexed BAM file in a pool of processes.
+
+The genome is split into shards, either one per reference or fixed size
+windows, and every read is assigned to the one shard containing its start
+position, so that reads spanning a shard boundary are only seen once.
+"""
+from multiprocessing import Pool
+
+from ..bam import Reader
+
+_worker_reader = None #the Reader opened by each worker process
+
+def get_shards( bam_reader, shard_size=None ):
+    #returns ( seq_id, start, end ) for each reference, or for windows of shard_size bases of each reference
+    shards = []
+    for seq_id, ( name, length ) in enumerate( bam_reader.get_references() ):
+        step = shard_size or length
+        for start in xrange( 0, length, step ):
+            shards.append( ( seq_id, start, min( start + step, length ) ) )
+    return shards
+
+def iter_shard_reads( bam_reader, shard ):
+    #yields the reads starting in the shard
+    seq_id, start, end = shard
+    for read in bam_reader.fetch( seq_id, start, end ):
+        if read.get_position_zero_based() >= start:
+            yield read
+
+def _open_worker_reader( filename, reader_kwds ):
+    global _worker_reader
+    _worker_reader = Reader( filename, **reader_kwds )
+
+def _run_shard( args ):
+    func, shard = args
+    return func( iter_shard_reads( _worker_reader, shard ), shard )
+
+def map_shards( filename, func, shard_size=None, processes=None, **reader_kwds ):
+    #yields func( reads, shard ) for every shard, in shard order; func must be a module level function so that it can be pickled
+    bam_reader = Reader( filename, **reader_kwds )
+    try:
+        assert bam_reader._bam_index, Exception( "You must provide a valid BAM index in order to process shards in parallel." )
+        shards = get_shards( bam_reader, shard_size )
+        if processes == 1:
+            for shard in shards:
+                yield func( iter_shard_reads( bam_reader, shard ), shard )
+            return
+    finally:
+        #also when func raises or the results are abandoned
+        bam_reader.close()
+    pool = Pool( processes, _open_worker_reader, ( filename, reader_kwds ) )
+    try:
+        for result in pool.imap( _run_shard, [ ( func, shard ) for shard in shards ] ):
+            yield result
+        pool.close()
+    finally:
+        pool.terminate()
+
+def map_reduce( filename, func, reduce_func=None, initial=None, shard_size=None, processes=None, **reader_kwds ):
+    #runs func( reads, shard ) over every shard and combines the results in shard order with reduce_func( accumulated, result ), or returns the list of results
+    results = map_shards( filename, func, shard_size=shard_size, processes=processes, **reader_kwds )
+    if reduce_func is None:
+        return list( results )
+    rval = initial
+    for result in results:
+        rval = reduce_func( rval, result )
+    return rval
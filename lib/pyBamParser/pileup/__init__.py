@@ -0,0 +1,168 @@
+"""
+Streaming pileup over coordinate sorted reads.
+
+For each reference position covered by at least one read, yields
+( ref_id, pos, entries ), pos zero-based, with one entry per covering read:
+
+    ( read, query_offset, base, quality, state, indel )
+
+state is one of PILEUP_MATCH, PILEUP_DELETION or PILEUP_REFERENCE_SKIP;
+base and quality are None unless the state is PILEUP_MATCH (both are also
+None for reads without a sequence, and quality for reads without qualities).
+indel is the length of an insertion following the position, minus the length
+of a deletion following it, or 0. M, =, X, D and N ops consume the reference
+and I, S, H and P do not, as in samtools; BAMRead.get_end_position() also
+counts H, so a read's entries can stop short of its end position. Only the
+reads overlapping the current position are held in memory, each as spans of
+entries: one entry per base of an aligned run, and a single entry for a whole
+deletion or skipped region, so a long intron costs no more than a short one.
+"""
+from ..read import DEFAULT_EXCLUDE_FLAGS
+
+PILEUP_MATCH = 0
+PILEUP_DELETION = 1
+PILEUP_REFERENCE_SKIP = 2
+
+CIGAR_OP_TO_PILEUP_STATE = { 2: PILEUP_DELETION, 3: PILEUP_REFERENCE_SKIP }
+
+def get_pileup_spans( read ):
+    #returns [ ref_offset, length, entry, entries ] spans of a read from its start to its end; aligned runs have one entry per base in entries
+    #and entry None, deletions and skipped regions share one entry over their length and have entries None
+    spans = []
+    seq = read.get_seq()
+    qual = read.get_qual()
+    query_offset = 0
+    ref_offset = 0
+    for op_len, op in read.get_cigar():
+        if op == 0 or op == 7: #M, = and X ( 8 & 0x07 == 0 )
+            if seq:
+                entries = [ ( read, i, seq[i], qual and qual[i], PILEUP_MATCH, 0 ) for i in xrange( query_offset, query_offset + op_len ) ]
+            else:
+                #SEQ is *
+                entries = [ ( read, i, None, None, PILEUP_MATCH, 0 ) for i in xrange( query_offset, query_offset + op_len ) ]
+            if entries:
+                spans.append( [ ref_offset, op_len, None, entries ] )
+            query_offset += op_len
+            ref_offset += op_len
+        elif op == 1 or op == 4: #I, S
+            if op == 1 and spans:
+                set_last_indel( spans, op_len )
+            query_offset += op_len
+        elif op in CIGAR_OP_TO_PILEUP_STATE: #D, N
+            if op == 2 and spans and spans[-1][3] is not None:
+                set_last_indel( spans, -op_len )
+            if op_len:
+                spans.append( [ ref_offset, op_len, ( read, query_offset, None, None, CIGAR_OP_TO_PILEUP_STATE[ op ], 0 ), None ] )
+            ref_offset += op_len
+    return spans
+
+def set_last_indel( spans, indel ):
+    #sets the indel of the entry at the last position of spans, splitting the last position off a shared run
+    ref_offset, length, entry, entries = spans[-1]
+    if entries is not None:
+        entries[-1] = entries[-1][:5] + ( indel, )
+    else:
+        if length > 1:
+            spans[-1][1] = length - 1
+            spans.append( [ ref_offset + length - 1, 1, entry, None ] )
+        spans[-1][2] = entry[:5] + ( indel, )
+
+def get_pileup_entries( read ):
+    #returns the entries of a read for each reference position from its start to its end
+    entries = []
+    for ref_offset, length, entry, span_entries in get_pileup_spans( read ):
+        if span_entries is None:
+            entries.extend( [ entry ] * length )
+        else:
+            entries.extend( span_entries )
+    return entries
+
+class Pileup( object ):
+    def __init__( self, reads, start=None, end=None, exclude_flags=DEFAULT_EXCLUDE_FLAGS, min_mapq=0 ):
+        #reads must be coordinate sorted, e.g. a bam.Reader or Reader.fetch(); positions outside of [start,end), on any reference, are not yielded
+        self._reads = reads
+        self._start = start
+        self._end = end
+        self._exclude_flags = exclude_flags
+        self._min_mapq = min_mapq
+        self._ref_id = None
+        self._pos = None
+        self._active = [] #[ start, end, spans, span index ] of the reads overlapping the current position, in order of start; ended reads are dropped
+        #once they outnumber the rest, so a long read at the front does not hold on to every read that ended after it
+        self.reads = 0 #reads added to the pileup
+        self.skipped = 0 #reads filtered out
+    
+    def __iter__( self ):
+        return self._iter_columns()
+    
+    def _advance( self, stop ):
+        #yields the columns from the current position up to stop, or until no read is left when stop is None
+        active = self._active
+        ref_id = self._ref_id
+        pos = self._pos
+        start = self._start
+        end = self._end
+        while active and ( stop is None or pos < stop ):
+            entries = []
+            for state in active:
+                read_start, read_end, spans, i = state
+                if read_end <= pos:
+                    continue
+                offset = pos - read_start
+                span = spans[i]
+                while span[0] + span[1] <= offset:
+                    i += 1
+                    span = spans[i]
+                state[3] = i
+                if span[3] is None:
+                    entries.append( span[2] )
+                else:
+                    entries.append( span[3][ offset - span[0] ] )
+            if 2 * len( entries ) < len( active ):
+                active[:] = [ state for state in active if state[1] > pos + 1 ]
+            if entries and ( start is None or pos >= start ) and ( end is None or pos < end ):
+                yield ref_id, pos, entries
+            pos += 1
+            self._pos = pos
+        if not active:
+            self._pos = stop
+    
+    def _iter_columns( self ):
+        exclude_flags = self._exclude_flags
+        min_mapq = self._min_mapq
+        for read in self._reads:
+            if read.get_flag() & exclude_flags or read.get_mapq() < min_mapq:
+                self.skipped += 1
+                continue
+            ref_id = read.get_reference_id()
+            read_start = read.get_position_zero_based()
+            if ref_id < 0 or read_start < 0:
+                self.skipped += 1
+                continue
+            if self._end is not None and read_start >= self._end:
+                self.skipped += 1
+                continue
+            if ref_id != self._ref_id:
+                for column in self._advance( None ):
+                    yield column
+                self._ref_id = ref_id
+                self._pos = read_start
+            else:
+                assert read_start >= self._pos, "Reads must be coordinate sorted for a pileup (%s at %i after %i)." % ( read.get_read_name(), read_start, self._pos )
+                for column in self._advance( read_start ):
+                    yield column
+                if not self._active:
+                    self._pos = read_start
+            spans = get_pileup_spans( read )
+            read_end = spans and read_start + spans[-1][0] + spans[-1][1] or read_start
+            if self._start is not None and read_end <= self._start:
+                self.skipped += 1
+                continue
+            self.reads += 1
+            self._active.append( [ read_start, read_end, spans, 0 ] )
+        for column in self._advance( None ):
+            yield column
+
+def pileup( reads, **kwds ):
+    #yields ( ref_id, pos, entries ) for each covered position, see Pileup
+    return iter( Pileup( reads, **kwds ) )
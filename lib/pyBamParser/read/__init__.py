@@ -3,8 +3,11 @@ import struct
 
 from ..util.packer import pack_int8, unpack_int8, pack_uint8, unpack_uint8, pack_int16, unpack_int16, pack_uint16, unpack_uint16, pack_int32, unpack_int32, pack_uint32, unpack_uint32, pack_int64, unpack_int64, pack_uint64, unpack_uint64
 from ..util import NULL_CHAR
+from ..bai import reg2bin
 
 BAM_NO_QUAL = 0xFF #255
+DEFAULT_EXCLUDE_FLAGS = 0x4 | 0x100 | 0x200 | 0x400 #unmapped, secondary, QC failed, duplicate; the reads pileup and coverage skip by default
+BAM_UNPLACED_BIN = 4680 #reg2bin( -1, 0 )
 SEQ_4_BIT_TO_SEQ = list( '=ACMGRSVTWYHKDBN' )
 
 CIGAR_OP = list( 'MIDNSHP=X' )
@@ -52,12 +55,15 @@ TAG_TYPE_TO_SAM_TYPE = {
                             }
 
 BAM_READ_BEGIN_UNPACKER = struct.Struct( "<iiIIiiii" ).unpack
+BAM_READ_BEGIN_UNPACK_FROM = struct.Struct( "<iiIIiiii" ).unpack_from
+REFERENCE_CIGAR_OPS = frozenset( [ 0, 2, 3, 5, 7, 8 ] ) #cigar ops that get_end_position() counts against the reference: M D N H = X
 READ_GROUP_RECORD_TAG = 'RG'
 CIGAR_RECORD_TAG = 'CG'
 
 SEQ_UNPACKERS = {} #cache seq unpackers for reuse
 QUAL_UNPACKERS = {}
 CIGAR_UNPACKERS = {}
+CIGAR_UNPACK_FROMS = {}
 
 #cache seq bit to 4 bit lookup
 SEQ_4_BIT_TO_SEQ_4 = [ SEQ_4_BIT_TO_SEQ[ i >> 4 ]  for i in range( 256 ) ]
@@ -65,6 +71,30 @@ SEQ_4_BIT_TO_SEQ_F = [ SEQ_4_BIT_TO_SEQ[ i & 0x0f ]  for i in range( 256 ) ]
 
 
 
+def get_cigar_unpack_from( n_cigar_op ):
+    cigar_unpack_from = CIGAR_UNPACK_FROMS.get( n_cigar_op, None )
+    if cigar_unpack_from is None:
+        cigar_unpack_from = struct.Struct( "<" +"I" * n_cigar_op ).unpack_from
+        CIGAR_UNPACK_FROMS[ n_cigar_op ] = cigar_unpack_from
+    return cigar_unpack_from
+
+def get_end_position_from_data( data, fields=None ):
+    #zero-based end position of a record, as BAMRead.get_end_position() gives, decoding only the fixed fields and cigar; fields are the BAM_READ_BEGIN_UNPACKER values if already unpacked
+    if fields is None:
+        fields = BAM_READ_BEGIN_UNPACK_FROM( data )
+    pos = fields[1]
+    n_cigar_op = fields[3] & 0xffff
+    if not n_cigar_op:
+        return pos
+    cigar = get_cigar_unpack_from( n_cigar_op )( data, 32 + ( fields[2] & 0xff ) )
+    if n_cigar_op == 2 and cigar[0] == ( fields[4] << 4 | 4 ) and cigar[1] & 0x0f == 3:
+        #the real cigar is stored in the CG tag
+        return BAMRead( data, None ).get_end_position( one_based=False )
+    for op in cigar:
+        if op & 0x0f in REFERENCE_CIGAR_OPS:
+            pos += op >> 4
+    return pos
+
 #TODO: FIXME: make parsing occur on-demand, by attribute, not at initialization
 class BAMRead( object ):
     
@@ -79,6 +109,8 @@ class BAMRead( object ):
         self._n_cigar_op = self._flag_nc & 0xffff
         
         self.__data = data
+        self._raw_data = data #written back as is by get_bam_data() until a set_ method modifies the read
+        self._modified = False
         self.__not_parsed_1 = True
         self.__not_parsed_2 = True
         self.__not_parsed_3 = True
@@ -152,7 +184,7 @@ class BAMRead( object ):
                 qual_unpacker = struct.Struct( "<" + "c" * self._l_seq ).unpack
                 QUAL_UNPACKERS[ self._l_seq ] = qual_unpacker
             self._qual = map( ord, qual_unpacker( self.__data[ self._block_offset: self._new_block_offset ] ) )
-            if self._qual[0] == BAM_NO_QUAL:
+            if not self._qual or self._qual[0] == BAM_NO_QUAL: #no SEQ, or no QUAL
                 self._qual = None
             
     def __parse_block_5( self ):
@@ -204,6 +236,11 @@ class BAMRead( object ):
     
     def get_flag( self ):
         return self._flag
+    def set_flag( self, flag ):
+        self._flag = flag
+        self._flag_nc = flag << 16 | self._flag_nc & 0xffff
+        self.__is_seq_reverse_complement = None
+        self._modified = True
     
     def get_reference( self ):
         if self.__reference is None:
@@ -218,6 +255,12 @@ class BAMRead( object ):
     def get_reference_id( self ):
         return self._ref_id
     
+    def set_reference_id( self, ref_id ):
+        self._ref_id = ref_id
+        self.__reference = None
+        self.__reference_name = None
+        self._modified = True
+    
     def _get_bam_ref_id( self ):
         return pack_int32( self._ref_id )
     
@@ -227,6 +270,12 @@ class BAMRead( object ):
     def get_rnext_name( self ):
         return self._reader.get_reference_name_by_id( self._next_ref_id, self._ref_id  )
     
+    def get_rnext_id( self ):
+        return self._next_ref_id
+    def set_rnext_id( self, ref_id ):
+        self._next_ref_id = ref_id
+        self._modified = True
+    
     def _get_bam_rnext_id( self ):
         return pack_int32( self._next_ref_id )
     
@@ -234,6 +283,16 @@ class BAMRead( object ):
         return self._pos + one_based
     def get_position_zero_based( self ):
         return self._pos
+    def set_position( self, position, one_based=True ):
+        #moves the alignment, keeping its cigar, and updates the bin
+        self._pos = position - one_based
+        self.__zero_based_end_position = None
+        if self._pos < 0:
+            self._bin = BAM_UNPLACED_BIN
+        else:
+            self._bin = reg2bin( self._pos, max( self.get_end_position( one_based=False ), self._pos + 1 ) )
+        self._bin_mq_nl = self._bin << 16 | self._bin_mq_nl & 0xffff
+        self._modified = True
     def _get_bam_pos( self ):
         return pack_int32( self.get_position( False ) )
 
@@ -326,11 +385,18 @@ class BAMRead( object ):
     
     def get_pnext( self, one_based=True ):
         return self._next_pos + one_based
+    def set_pnext( self, position, one_based=True ):
+        self._next_pos = position - one_based
+        self._modified = True
     def _get_bam_next_pos( self ):
         return pack_int32( self.get_pnext( False ) )
     
     def get_mapq( self ):
         return self._mapq
+    def set_mapq( self, mapq ):
+        self._mapq = mapq
+        self._bin_mq_nl = self._bin_mq_nl & 0xffff00ff | mapq << 8
+        self._modified = True
     
     def get_cigar( self ):
         self.__parse_block_2()
@@ -355,6 +421,9 @@ class BAMRead( object ):
     
     def get_t_len( self ):
         return self._t_len
+    def set_t_len( self, t_len ):
+        self._t_len = t_len
+        self._modified = True
     def _get_bam_t_len( self ):
         return pack_int32( self._t_len )
     
@@ -451,7 +520,16 @@ class BAMRead( object ):
                 data += struct.pack( "<" + TAG_TYPE_TO_STRUCT_TYPE[ val_type ] * tag_length, *value )
         return data
     
+    def is_modified( self ):
+        return self._modified
+    def mark_modified( self ):
+        #for changes made other than through the set_ methods, so that get_bam_data() re-serializes the read
+        self._modified = True
+    
     def get_bam_data( self ):
+        if not self._modified:
+            #the original record, no need to parse and re-pack every field
+            return "%s%s" % ( pack_int32( self._block_size ), self._raw_data )
         #FIX ME: have these calculate from updatable properties
         rval = "%s%s%s%s%s%s%s%s%s%s%s%s%s" % ( self._get_bam_ref_id(), self._get_bam_pos(), self._get_bam_bin_mq_nl(), 
                                                 self._get_bam_flag_nc(), self._get_bam_seq_length(), self._get_bam_rnext_id(),
@@ -0,0 +1,178 @@
+"""
+External memory sort of BAM files, by coordinate or by read name.
+
+Alignment records are buffered up to a memory budget, sorted and spilled as
+runs to temporary BGZF files with fast compression, then merged into the
+output BAM. Records are never decoded into BAMReads, their bytes are written
+back as read.
+"""
+import heapq
+import os
+import shutil
+import sys
+import tempfile
+import threading
+from operator import itemgetter
+
+from ..bam import Reader, Writer
+from ..bgzf import Reader as BGZFReader
+from ..bgzf import Writer as BGZFWriter
+from ..read import BAM_READ_BEGIN_UNPACK_FROM
+from ..util import STANDARD_STREAM_FILENAME
+from ..util.packer import pack_int32, unpack_int32_from
+
+SORT_ORDER_COORDINATE = 'coordinate'
+SORT_ORDER_QUERYNAME = 'queryname'
+SAM_HEADER_VERSION = '1.6' #used when the header has no @HD line to record the sort order in
+DEFAULT_MAX_MEMORY = 2**29 #bytes of buffered records, including the one being spilled
+RECORD_OVERHEAD = 120 #approximate bytes held per buffered record besides its data
+RUN_COMPRESS_LEVEL = 1
+
+def get_coordinate_key( data ):
+    #reference, position and strand packed into one int; reads without a reference (-1) sort last
+    ref_id, pos, bin_mq_nl, flag_nc = BAM_READ_BEGIN_UNPACK_FROM( data )[:4]
+    return ( ref_id & 0xffffffff ) << 33 | ( pos + 1 ) << 1 | flag_nc >> 20 & 1
+
+def get_queryname_key( data ):
+    #the NULL terminated read name, in plain byte order, then first before second in pair
+    ref_id, pos, bin_mq_nl, flag_nc = BAM_READ_BEGIN_UNPACK_FROM( data )[:4]
+    return "%s%s" % ( data[ 32:32 + ( bin_mq_nl & 0xff ) ], chr( flag_nc >> 22 & 3 ) )
+
+SORT_KEYS = { SORT_ORDER_COORDINATE: get_coordinate_key, SORT_ORDER_QUERYNAME: get_queryname_key }
+
+def set_header_sort_order( headers, sort_order ):
+    #returns the SAM header text with SO:sort_order in its @HD line
+    lines = headers.split( '\n' )
+    if lines[0].startswith( '@HD' ):
+        fields = [ field for field in lines[0].rstrip( '\r' ).split( '\t' ) if not field.startswith( 'SO:' ) ]
+        fields.append( 'SO:%s' % ( sort_order ) )
+        lines[0] = '\t'.join( fields )
+    else:
+        lines.insert( 0, '@HD\tVN:%s\tSO:%s' % ( SAM_HEADER_VERSION, sort_order ) )
+    return '\n'.join( lines )
+
+def _write_run( filename, records, threads ):
+    #sorts the ( key, data ) records, keeping input order for equal keys, and writes their data with block sizes
+    records.sort( key=itemgetter( 0 ) )
+    writer = BGZFWriter( filename, compress_level=RUN_COMPRESS_LEVEL, threads=threads )
+    writer.write_many( "%s%s" % ( pack_int32( len( data ) ), data ) for key, data in records )
+    writer.close()
+
+class _RunWriter( threading.Thread ):
+    #writes a run in the background; an exception raised while writing is raised again by join()
+    def __init__( self, filename, records, threads ):
+        threading.Thread.__init__( self )
+        self._run_args = ( filename, records, threads )
+        self._exc_info = None
+    
+    def run( self ):
+        try:
+            _write_run( *self._run_args )
+        except:
+            self._exc_info = sys.exc_info()
+    
+    def join( self ):
+        threading.Thread.join( self )
+        if self._exc_info is not None:
+            exc_type, exc_value, exc_traceback = self._exc_info
+            self._exc_info = None
+            raise exc_type, exc_value, exc_traceback
+
+def _iter_run( filename, run_index, key_func ):
+    #yields ( key, run_index, record number, data ) for the records of a run file
+    reader = BGZFReader( filename )
+    buffer = ''
+    offset = 0
+    i = 0
+    while True:
+        try:
+            block = reader.next()
+        except StopIteration:
+            break
+        buffer = "%s%s" % ( buffer[ offset: ], block )
+        offset = 0
+        while offset + 4 <= len( buffer ):
+            end = offset + 4 + unpack_int32_from( buffer, offset )[0]
+            if end > len( buffer ):
+                break
+            data = buffer[ offset + 4:end ]
+            yield key_func( data ), run_index, i, data
+            i += 1
+            offset = end
+    reader.close()
+    assert offset == len( buffer ), "Truncated record at the end of sort run %s." % ( filename )
+
+def _iter_records( records, run_index ):
+    records.sort( key=itemgetter( 0 ) )
+    for i, ( key, data ) in enumerate( records ):
+        yield key, run_index, i, data
+
+def sort_bam( input_filename, output_filename, sort_order=SORT_ORDER_COORDINATE, max_memory=DEFAULT_MAX_MEMORY, threads=None, tmp_dir=None, compress_level=6, index=False ):
+    #sorts a BAM file into output_filename and returns { 'records', 'runs' };
+    #each full buffer is sorted and spilled by a background thread, and compressed by threads, while the next one fills;
+    #index writes a .bai for coordinate sorted output; when sorting fails, the partial output is removed
+    key_func = SORT_KEYS[ sort_order ]
+    assert not index or sort_order == SORT_ORDER_COORDINATE, Exception( "Only coordinate sorted BAM files can be indexed." )
+    reader = Reader( input_filename, threads=threads )
+    writer = None
+    buffer_size = max_memory / 2 #a full buffer can be spilling while the next one fills
+    tmp_dir = tempfile.mkdtemp( prefix='pyBamParser_sort_', dir=tmp_dir )
+    spill = None
+    try:
+        runs = []
+        records = []
+        size = 0
+        n_records = 0
+        while True:
+            try:
+                data = reader.next_raw()
+            except StopIteration:
+                break
+            records.append( ( key_func( data ), data ) )
+            size += len( data ) + RECORD_OVERHEAD
+            if size >= buffer_size:
+                if spill is not None:
+                    spill.join()
+                runs.append( os.path.join( tmp_dir, "run%06i.bgzf" % ( len( runs ) ) ) )
+                spill = _RunWriter( runs[-1], records, threads )
+                spill.start()
+                n_records += len( records )
+                records = []
+                size = 0
+        if spill is not None:
+            spill.join()
+        n_records += len( records )
+        #the last buffer is merged from memory
+        sources = [ _iter_run( filename, i, key_func ) for i, filename in enumerate( runs ) ]
+        sources.append( _iter_records( records, len( runs ) ) )
+        writer = Writer( output_filename, headers=set_header_sort_order( reader._headers, sort_order ), references=reader.get_references(),
+                         threads=threads, compress_level=compress_level, index=index )
+        write_raw = writer.write_raw
+        n_written = 0
+        if len( sources ) == 1:
+            for key, run_index, i, data in sources[0]:
+                write_raw( data )
+                n_written += 1
+        else:
+            for key, run_index, i, data in heapq.merge( *sources ):
+                write_raw( data )
+                n_written += 1
+        if n_written != n_records:
+            raise IOError( "Sorting %s read %i records, but merged %i from the sort runs." % ( input_filename, n_records, n_written ) )
+    except:
+        #let a spill that is still running finish before its directory is removed, and throw away the partial output
+        if spill is not None:
+            threading.Thread.join( spill )
+        if writer is not None:
+            writer.abort()
+            if isinstance( output_filename, basestring ) and output_filename != STANDARD_STREAM_FILENAME:
+                for filename in ( output_filename, getattr( writer, '_index_filename', None ) ):
+                    if filename and os.path.exists( filename ):
+                        os.remove( filename )
+        raise
+    else:
+        writer.close()
+    finally:
+        reader.close()
+        shutil.rmtree( tmp_dir, ignore_errors=True )
+    return { 'records': n_records, 'runs': len( sources ) }
@@ -1,5 +1,8 @@
 #Dan Blankenberg
+import sys
+
 NULL_CHAR = '\x00'
+STANDARD_STREAM_FILENAME = '-'
 
 try:
     from cStringIO import StringIO
@@ -7,7 +10,12 @@ except ImportError:
     from StringIO import StringIO
 
 def get_filename_and_open( filename, default=None, mode='rb'):
-    if isinstance( filename, basestring ):
+    if filename == STANDARD_STREAM_FILENAME:
+        if 'r' in mode:
+            fh = sys.stdin
+        else:
+            fh = sys.stdout
+    elif isinstance( filename, basestring ):
         fh = open( filename, mode )
     else:
         fh = filename
@@ -16,3 +24,10 @@ def get_filename_and_open( filename, default=None, mode='rb'):
         except AttributeError:
             filename = default
     return filename, fh
+
+def is_seekable( fh ):
+    try:
+        fh.seek( fh.tell() )
+    except ( IOError, AttributeError ):
+        return False
+    return True
@@ -0,0 +1,51 @@
+"""
+Least recently used cache, bounded by the total size of its values.
+"""
+
+from collections import OrderedDict
+
+class LRUCache( object ):
+    """
+    Maps keys to values, evicting the least recently used entries once the
+    sum of the sizes given to set() exceeds max_size. Lookups are counted
+    as hits and misses.
+    """
+    def __init__( self, max_size ):
+        self.max_size = max_size
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict() #key -> ( value, size ), least recently used first
+    
+    def __len__( self ):
+        return len( self._entries )
+    
+    def __contains__( self, key ):
+        return key in self._entries
+    
+    def get( self, key, default=None ):
+        try:
+            value, size = self._entries.pop( key )
+        except KeyError:
+            self.misses += 1
+            return default
+        self._entries[ key ] = ( value, size ) #move to most recently used
+        self.hits += 1
+        return value
+    
+    def set( self, key, value, size ):
+        if key in self._entries:
+            self.size -= self._entries.pop( key )[1]
+        if size > self.max_size:
+            return
+        self._entries[ key ] = ( value, size )
+        self.size += size
+        while self.size > self.max_size:
+            self.size -= self._entries.popitem( last=False )[1][1]
+    
+    def clear( self ):
+        self._entries.clear()
+        self.size = 0
+    
+    def get_stats( self ):
+        return { 'hits': self.hits, 'misses': self.misses, 'entries': len( self._entries ), 'size': self.size, 'max_size': self.max_size }
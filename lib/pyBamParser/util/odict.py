@@ -23,9 +23,9 @@ class odict(UserDict):
         self._keys.remove( key )
 
     def __setitem__( self, key, item ):
-        UserDict.__setitem__( self, key, item )
-        if key not in self._keys:
+        if key not in self.data:
             self._keys.append( key )
+        UserDict.__setitem__( self, key, item )
 
     def clear( self ):
         UserDict.clear( self )
@@ -52,7 +52,7 @@ class odict(UserDict):
         return ( key, val )
 
     def setdefault( self, key, failobj=None ):
-        if key not in self._keys:
+        if key not in self.data:
             self._keys.append( key )
         return UserDict.setdefault( self, key, failobj )
 
@@ -82,6 +82,6 @@ class odict(UserDict):
         self._keys.reverse()
 
     def insert( self, index, key, item ):
-        if key not in self._keys:
+        if key not in self.data:
             self._keys.insert( index, key )
             UserDict.__setitem__( self, key, item )
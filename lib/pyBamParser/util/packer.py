@@ -39,7 +39,9 @@ UINT64_SIZE = UINT64_PACKER.size
 pack_int8 = INT8_PACKER.pack
 pack_uint8 = UINT8_PACKER.pack
 unpack_int8 = INT8_PACKER.unpack
+unpack_int8_from = INT8_PACKER.unpack_from
 unpack_uint8 = UINT8_PACKER.unpack
+unpack_uint8_from = UINT8_PACKER.unpack_from
 def unpack_int8_reader( reader ):
     return INT8_PACKER.unpack( reader.read( INT8_SIZE ) )
 def unpack_uint8_reader( reader ):
@@ -48,7 +50,9 @@ def unpack_uint8_reader( reader ):
 pack_int16 = INT16_PACKER.pack
 pack_uint16 = UINT16_PACKER.pack
 unpack_int16 = INT16_PACKER.unpack
+unpack_int16_from = INT16_PACKER.unpack_from
 unpack_uint16 = UINT16_PACKER.unpack
+unpack_uint16_from = UINT16_PACKER.unpack_from
 def unpack_int16_reader( reader ):
     return INT16_PACKER.unpack( reader.read( INT16_SIZE ) )
 def unpack_uint16_reader( reader ):
@@ -57,7 +61,9 @@ def unpack_uint16_reader( reader ):
 pack_int32 = INT32_PACKER.pack
 pack_uint32 = UINT32_PACKER.pack
 unpack_int32 = INT32_PACKER.unpack
+unpack_int32_from = INT32_PACKER.unpack_from
 unpack_uint32 = UINT32_PACKER.unpack
+unpack_uint32_from = UINT32_PACKER.unpack_from
 def unpack_int32_reader( reader ):
     return INT32_PACKER.unpack( reader.read( INT32_SIZE ) )
 def unpack_uint32_reader( reader ):
@@ -66,7 +72,9 @@ def unpack_uint32_reader( reader ):
 pack_int64 = INT64_PACKER.pack
 pack_uint64 = UINT64_PACKER.pack
 unpack_int64 = INT64_PACKER.unpack
+unpack_int64_from = INT64_PACKER.unpack_from
 unpack_uint64 = UINT64_PACKER.unpack
+unpack_uint64_from = UINT64_PACKER.unpack_from
 def unpack_int64_reader( reader ):
     return INT64_PACKER.unpack( reader.read( INT64_SIZE ) )
 def unpack_uint64_reader( reader ):
@@ -17,6 +17,10 @@ from glob import glob
 extra = {}
 if sys.version_info >= (3,):
     extra['use_2to3'] = True
+else:
+    #bam.aio needs trollius in place of asyncio, and tests/tests.sh runs its test
+    extra['extras_require'] = { 'async': [ 'trollius' ] }
+    extra['tests_require'] = [ 'numpy', 'trollius' ]
 
        
 def main():
@@ -5,3 +5,101 @@ echo -e "\tBAMRead.get_indels/cigar-varieties.bam:"
 PYTHONPATH=$dirname/../lib $dirname/unit.test.py BAMRead.get_indels $dirname/cigar-varieties.bam | diff -s - $dirname/cigar-varieties.get_indels.out
 echo -e "\tBAMRead.indel_at/cigar-varieties.bam:"
 PYTHONPATH=$dirname/../lib $dirname/unit.test.py BAMRead.indel_at $dirname/cigar-varieties.bam -i $dirname/cigar-varieties.indel_at.tsv | diff -s - $dirname/cigar-varieties.indel_at.out
+echo -e "\tBAMRead.get_indels/clipped-noseq.bam:"
+PYTHONPATH=$dirname/../lib $dirname/unit.test.py BAMRead.get_indels $dirname/clipped-noseq.bam | diff -s - $dirname/clipped-noseq.get_indels.out
+echo -e "\tBAMRead.indel_at/clipped-noseq.bam:"
+PYTHONPATH=$dirname/../lib $dirname/unit.test.py BAMRead.indel_at $dirname/clipped-noseq.bam -i $dirname/clipped-noseq.indel_at.tsv | diff -s - $dirname/clipped-noseq.indel_at.out
+echo -e "\tBAMRead.get_indels/cigar-varieties.bam (threaded):"
+PYTHONPATH=$dirname/../lib $dirname/unit.test.py BAMRead.get_indels $dirname/cigar-varieties.bam -t 2 | diff -s - $dirname/cigar-varieties.get_indels.out
+echo -e "\tBAMRead.get_indels/cigar-varieties.bam (mmap):"
+PYTHONPATH=$dirname/../lib $dirname/unit.test.py BAMRead.get_indels $dirname/cigar-varieties.bam -m | diff -s - $dirname/cigar-varieties.get_indels.out
+echo -e "\tBAMRead.get_indels/cigar-varieties.bam (stdin):"
+cat $dirname/cigar-varieties.bam | PYTHONPATH=$dirname/../lib $dirname/unit.test.py BAMRead.get_indels - | diff -s - $dirname/cigar-varieties.get_indels.out
+echo -e "\tReader.fetch/cigar-varieties.bam:"
+PYTHONPATH=$dirname/../lib $dirname/unit.test.py Reader.fetch $dirname/cigar-varieties.bam -r $dirname/cigar-varieties.regions.bed | diff -s - $dirname/cigar-varieties.fetch.out
+echo -e "\tReader.fetch/cigar-varieties.bam (samtools index):"
+PYTHONPATH=$dirname/../lib $dirname/unit.test.py Reader.fetch $dirname/cigar-varieties.bam -r $dirname/cigar-varieties.regions.bed -x $dirname/cigar-varieties.bam.bai | diff -s - $dirname/cigar-varieties.fetch.out
+echo -e "\tReader.fetch_many/cigar-varieties.bam:"
+PYTHONPATH=$dirname/../lib $dirname/unit.test.py Reader.fetch_many $dirname/cigar-varieties.bam -r $dirname/cigar-varieties.regions.bed | diff -s - $dirname/cigar-varieties.fetch_many.out
+echo -e "\tReader.fetch_many/cigar-varieties.bam (samtools index):"
+PYTHONPATH=$dirname/../lib $dirname/unit.test.py Reader.fetch_many $dirname/cigar-varieties.bam -r $dirname/cigar-varieties.regions.bed -x $dirname/cigar-varieties.bam.bai | diff -s - $dirname/cigar-varieties.fetch_many.out
+echo -e "\tReader.fetch_many/cigar-varieties.bam (overlapping regions):"
+PYTHONPATH=$dirname/../lib $dirname/unit.test.py Reader.fetch_many $dirname/cigar-varieties.bam -r $dirname/cigar-varieties.overlapping.bed | diff -s - $dirname/cigar-varieties.fetch_many_overlapping.out
+echo -e "\tReader.fetch_many/cigar-varieties.bam (overlapping regions, samtools index):"
+PYTHONPATH=$dirname/../lib $dirname/unit.test.py Reader.fetch_many $dirname/cigar-varieties.bam -r $dirname/cigar-varieties.overlapping.bed -x $dirname/cigar-varieties.bam.bai | diff -s - $dirname/cigar-varieties.fetch_many_overlapping.out
+echo -e "\tpileup/cigar-varieties.bam:"
+PYTHONPATH=$dirname/../lib $dirname/unit.test.py pileup $dirname/cigar-varieties.bam | diff -s - $dirname/cigar-varieties.pileup.out
+echo -e "\tReader.idxstats/cigar-varieties.bam:"
+PYTHONPATH=$dirname/../lib $dirname/unit.test.py Reader.idxstats $dirname/cigar-varieties.bam | diff -s - $dirname/cigar-varieties.idxstats.out
+echo -e "\tReader.idxstats/cigar-varieties.bam (samtools index):"
+PYTHONPATH=$dirname/../lib $dirname/unit.test.py Reader.idxstats $dirname/cigar-varieties.bam -x $dirname/cigar-varieties.bam.bai | diff -s - $dirname/cigar-varieties.idxstats.out
+echo -e "\tWriter.copy/cigar-varieties.bam:"
+PYTHONPATH=$dirname/../lib $dirname/unit.test.py Writer.copy $dirname/cigar-varieties.bam | diff -s - $dirname/cigar-varieties.copy.out
+echo -e "\tWriter.index/cigar-varieties.bam:"
+PYTHONPATH=$dirname/../lib $dirname/unit.test.py Writer.index $dirname/cigar-varieties.bam -r $dirname/cigar-varieties.regions.bed -x $dirname/cigar-varieties.bam.bai | diff -s - $dirname/cigar-varieties.index.out
+echo -e "\tWriter.index/clipped-noseq.bam:"
+PYTHONPATH=$dirname/../lib $dirname/unit.test.py Writer.index $dirname/clipped-noseq.bam -r $dirname/clipped-noseq.regions.bed -x $dirname/clipped-noseq.bam.bai | diff -s - $dirname/clipped-noseq.index.out
+echo -e "\tWriter.index/filter-chunks.bam:"
+PYTHONPATH=$dirname/../lib $dirname/unit.test.py Writer.index $dirname/filter-chunks.bam -r $dirname/filter-chunks.regions.bed -x $dirname/filter-chunks.bam.bai | diff -s - $dirname/filter-chunks.index.out
+echo -e "\tsort_bam/cigar-varieties.bam:"
+PYTHONPATH=$dirname/../lib $dirname/unit.test.py sort_bam $dirname/cigar-varieties.bam | diff -s - $dirname/cigar-varieties.sort_bam.out
+echo -e "\tsort_bam/cigar-varieties.bam (threaded):"
+PYTHONPATH=$dirname/../lib $dirname/unit.test.py sort_bam $dirname/cigar-varieties.bam -t 2 | diff -s - $dirname/cigar-varieties.sort_bam.out
+echo -e "\tsort_bam.errors/cigar-varieties.bam:"
+PYTHONPATH=$dirname/../lib $dirname/unit.test.py sort_bam.errors $dirname/cigar-varieties.bam | diff -s - $dirname/cigar-varieties.sort_bam_errors.out
+echo -e "\tsort_bam.errors/cigar-varieties.bam (threaded):"
+PYTHONPATH=$dirname/../lib $dirname/unit.test.py sort_bam.errors $dirname/cigar-varieties.bam -t 2 | diff -s - $dirname/cigar-varieties.sort_bam_errors.out
+echo -e "\tMatePairer/mate-pairs.bam:"
+PYTHONPATH=$dirname/../lib $dirname/unit.test.py MatePairer $dirname/mate-pairs.bam | diff -s - $dirname/mate-pairs.MatePairer.out
+echo -e "\tpileup.columns/clipped-noseq.bam:"
+PYTHONPATH=$dirname/../lib $dirname/unit.test.py pileup.columns $dirname/clipped-noseq.bam | diff -s - $dirname/clipped-noseq.pileup.out
+echo -e "\tget_depth/clipped-noseq.bam:"
+PYTHONPATH=$dirname/../lib $dirname/unit.test.py get_depth $dirname/clipped-noseq.bam | diff -s - $dirname/clipped-noseq.get_depth.out
+echo -e "\twrite_bedgraph/clipped-noseq.bam:"
+PYTHONPATH=$dirname/../lib $dirname/unit.test.py write_bedgraph $dirname/clipped-noseq.bam | diff -s - $dirname/clipped-noseq.write_bedgraph.out
+echo -e "\twrite_bedgraph/cigar-varieties.bam:"
+PYTHONPATH=$dirname/../lib $dirname/unit.test.py write_bedgraph $dirname/cigar-varieties.bam | diff -s - $dirname/cigar-varieties.write_bedgraph.out
+echo -e "\tReader.cache/cigar-varieties.bam:"
+PYTHONPATH=$dirname/../lib $dirname/unit.test.py Reader.cache $dirname/cigar-varieties.bam | diff -s - $dirname/cigar-varieties.cache.out
+echo -e "\tReader.cache/cigar-varieties.bam (threaded):"
+PYTHONPATH=$dirname/../lib $dirname/unit.test.py Reader.cache $dirname/cigar-varieties.bam -t 2 | diff -s - $dirname/cigar-varieties.cache.out
+echo -e "\tbgzf.gzi/cigar-varieties.bam:"
+PYTHONPATH=$dirname/../lib $dirname/unit.test.py bgzf.gzi $dirname/cigar-varieties.bam | diff -s - $dirname/cigar-varieties.gzi.out
+echo -e "\tbgzf.gzi/cigar-varieties.bam (threaded):"
+PYTHONPATH=$dirname/../lib $dirname/unit.test.py bgzf.gzi $dirname/cigar-varieties.bam -t 2 | diff -s - $dirname/cigar-varieties.gzi.out
+echo -e "\tbgzf.truncated/cigar-varieties.bam:"
+PYTHONPATH=$dirname/../lib $dirname/unit.test.py bgzf.truncated $dirname/cigar-varieties.bam | diff -s - $dirname/cigar-varieties.truncated.out
+echo -e "\tbgzf.truncated/cigar-varieties.bam (threaded):"
+PYTHONPATH=$dirname/../lib $dirname/unit.test.py bgzf.truncated $dirname/cigar-varieties.bam -t 2 | diff -s - $dirname/cigar-varieties.truncated.out
+echo -e "\tbgzf.block_stats/cigar-varieties.bam:"
+PYTHONPATH=$dirname/../lib $dirname/unit.test.py bgzf.block_stats $dirname/cigar-varieties.bam | diff -s - $dirname/cigar-varieties.block_stats.out
+echo -e "\tbgzf.extra_subfields/cigar-varieties.bam:"
+PYTHONPATH=$dirname/../lib $dirname/unit.test.py bgzf.extra_subfields $dirname/cigar-varieties.bam | diff -s - $dirname/cigar-varieties.extra_subfields.out
+echo -e "\tbgzf.extra_subfields/cigar-varieties.bam (threaded):"
+PYTHONPATH=$dirname/../lib $dirname/unit.test.py bgzf.extra_subfields $dirname/cigar-varieties.bam -t 2 | diff -s - $dirname/cigar-varieties.extra_subfields.out
+echo -e "\tbgzf.Writer/cigar-varieties.bam:"
+PYTHONPATH=$dirname/../lib $dirname/unit.test.py bgzf.Writer $dirname/cigar-varieties.bam | diff -s - $dirname/cigar-varieties.bgzf_writer.out
+echo -e "\tmap_shards/cigar-varieties.bam:"
+PYTHONPATH=$dirname/../lib $dirname/unit.test.py map_shards $dirname/cigar-varieties.bam | diff -s - $dirname/cigar-varieties.map_shards.out
+echo -e "\tReader.fetch/clipped-noseq.bam:"
+PYTHONPATH=$dirname/../lib $dirname/unit.test.py Reader.fetch $dirname/clipped-noseq.bam -r $dirname/clipped-noseq.regions.bed | diff -s - $dirname/clipped-noseq.fetch.out
+echo -e "\tReader.fetch/clipped-noseq.bam (samtools index):"
+PYTHONPATH=$dirname/../lib $dirname/unit.test.py Reader.fetch $dirname/clipped-noseq.bam -r $dirname/clipped-noseq.regions.bed -x $dirname/clipped-noseq.bam.bai | diff -s - $dirname/clipped-noseq.fetch.out
+echo -e "\tReader.next_batch/cigar-varieties.bam:"
+PYTHONPATH=$dirname/../lib $dirname/unit.test.py Reader.next_batch $dirname/cigar-varieties.bam | diff -s - $dirname/cigar-varieties.next_batch.out
+echo -e "\tReader.next_batch/cigar-varieties.bam (threaded):"
+PYTHONPATH=$dirname/../lib $dirname/unit.test.py Reader.next_batch $dirname/cigar-varieties.bam -t 2 | diff -s - $dirname/cigar-varieties.next_batch.out
+echo -e "\tReader.next_batch/clipped-noseq.bam:"
+PYTHONPATH=$dirname/../lib $dirname/unit.test.py Reader.next_batch $dirname/clipped-noseq.bam | diff -s - $dirname/clipped-noseq.next_batch.out
+echo -e "\tReader.filter/filter-chunks.bam:"
+PYTHONPATH=$dirname/../lib $dirname/unit.test.py Reader.filter $dirname/filter-chunks.bam -r $dirname/filter-chunks.regions.bed | diff -s - $dirname/filter-chunks.filter.out
+echo -e "\tReader.filter/filter-chunks.bam (samtools index):"
+PYTHONPATH=$dirname/../lib $dirname/unit.test.py Reader.filter $dirname/filter-chunks.bam -r $dirname/filter-chunks.regions.bed -x $dirname/filter-chunks.bam.bai | diff -s - $dirname/filter-chunks.filter.out
+echo -e "\tReaderPool/cigar-varieties.bam:"
+PYTHONPATH=$dirname/../lib $dirname/unit.test.py ReaderPool $dirname/cigar-varieties.bam | diff -s - $dirname/cigar-varieties.ReaderPool.out
+echo -e "\tReaderPool/cigar-varieties.bam (threaded):"
+PYTHONPATH=$dirname/../lib $dirname/unit.test.py ReaderPool $dirname/cigar-varieties.bam -t 2 | diff -s - $dirname/cigar-varieties.ReaderPool.out
+echo -e "\tAsyncReader/cigar-varieties.bam:"
+PYTHONPATH=$dirname/../lib $dirname/unit.test.py AsyncReader $dirname/cigar-varieties.bam | diff -s - $dirname/cigar-varieties.AsyncReader.out
+echo -e "\tAsyncReader/cigar-varieties.bam (threaded):"
+PYTHONPATH=$dirname/../lib $dirname/unit.test.py AsyncReader $dirname/cigar-varieties.bam -t 2 | diff -s - $dirname/cigar-varieties.AsyncReader.out
@@ -1,13 +1,36 @@
 #!/usr/bin/env python
 import os
 import sys
+import bisect
+import random
+import struct
+import itertools
+import shutil
+import tempfile
+import threading
 # hack to prefer local version over installed egg
 if os.environ.get('PYTHONPATH'):
   newpath = [os.path.abspath(os.environ.get('PYTHONPATH'))]
   newpath.extend(sys.path)
   sys.path = newpath
 from pyBamParser.read import BAMRead
-from pyBamParser.bam import Reader
+from pyBamParser.bam import Reader, Writer, RecordFilter, ReaderPool
+from pyBamParser.bam import aio
+from pyBamParser.bgzf import Reader as BGZFReader
+from pyBamParser.bgzf import MmapReader as BGZFMmapReader
+from pyBamParser.bgzf import StreamReader as BGZFStreamReader
+from pyBamParser.bgzf import scan_blocks, get_block_stats
+from pyBamParser.bgzf import Writer as BGZFWriter
+from pyBamParser.bgzf import get_deflate_backend, get_available_deflate_backends
+from StringIO import StringIO
+from pyBamParser.bai import reg2bin
+from pyBamParser.pileup import pileup, PILEUP_MATCH
+from pyBamParser.coverage import get_depth, iter_bedgraph, write_bedgraph
+from pyBamParser.pair import MatePairer
+from pyBamParser.parallel import map_shards, map_reduce, get_shards
+from pyBamParser.sort import sort_bam, get_coordinate_key, get_queryname_key
+from pyBamParser import sort as sort_module
+from pyBamParser import bgzf as bgzf_module
 from optparse import OptionParser
 
 def main():
@@ -15,10 +38,34 @@ def main():
   FUNCTIONS = {
     'BAMRead.get_indels':BAMRead_get_indels,
     'BAMRead.indel_at':BAMRead_indel_at,
+    'Reader.fetch':Reader_fetch,
+    'Reader.fetch_many':Reader_fetch_many,
+    'Reader.idxstats':Reader_idxstats,
+    'Reader.filter':Reader_filter,
+    'Writer.copy':Writer_copy,
+    'Writer.index':Writer_index,
+    'Reader.cache':Reader_cache,
+    'ReaderPool':ReaderPool_threads,
+    'AsyncReader':AsyncReader_fetch,
+    'Reader.next_batch':Reader_next_batch,
+    'bgzf.gzi':bgzf_gzi,
+    'bgzf.truncated':bgzf_truncated,
+    'bgzf.block_stats':bgzf_block_stats,
+    'bgzf.extra_subfields':bgzf_extra_subfields,
+    'bgzf.Writer':bgzf_writer,
+    'sort_bam':sort_bam_orders,
+    'sort_bam.errors':sort_bam_errors,
+    'MatePairer':mate_pairs,
+    'map_shards':parallel_shards,
+    'pileup':pileup_indels,
+    'pileup.columns':pileup_columns,
+    'get_depth':get_depth_runs,
+    'write_bedgraph':bedgraph_windows,
   }
 
-  OPT_DEFAULTS = {'indels_file':'', 'int':0, 'bool':False}
-  USAGE = "USAGE: %prog [options] function.to.test reads.bam"
+  OPT_DEFAULTS = {'indels_file':'', 'regions_file':'', 'index_file':'', 'threads':0,
+    'mmap':False, 'int':0, 'bool':False}
+  USAGE = "USAGE: %prog [options] function.to.test reads.bam (or - for stdin)"
   DESCRIPTION = """Run test on a given function and input BAM and print results.
   Give one of the following function names: """+', '.join(FUNCTIONS)
   EPILOG = """ """
@@ -30,6 +77,19 @@ def main():
     help="""A file containing indels to test for. Required for BAMRead.indel_at.
 Format: One indel per line, 3 tab-separated columns: 1. chrom, 2. coordinate
 (1-based), "I" or "D" or "ID" for insertion, deletion, or both.""")
+  parser.add_option('-r', '--regions-file', dest='regions_file',
+    default=OPT_DEFAULTS.get('regions_file'),
+    help="""A BED file of regions to fetch. Required for Reader.fetch.""")
+  parser.add_option('-x', '--index-file', dest='index_file',
+    default=OPT_DEFAULTS.get('index_file'),
+    help="""A BAI index of the BAM file (e.g. made by samtools index) for
+Reader.fetch and Reader.idxstats to use, instead of indexing a copy.""")
+  parser.add_option('-t', '--threads', dest='threads', type='int',
+    default=OPT_DEFAULTS.get('threads'),
+    help="""Number of threads to use for BGZF block decompression.""")
+  parser.add_option('-m', '--mmap', dest='mmap', action='store_true',
+    default=OPT_DEFAULTS.get('mmap'),
+    help="""Read the BAM file through a memory map.""")
 
   (options, arguments) = parser.parse_args()
 
@@ -42,10 +102,14 @@ Format: One indel per line, 3 tab-separated columns: 1. chrom, 2. coordinate
   if function not in FUNCTIONS:
     fail('Error: function "'+function+'" not supported. Please pick one from '
       +'the list: '+', '.join(FUNCTIONS))
-  if not os.path.exists(bamfilename):
+  if bamfilename != '-' and not os.path.exists(bamfilename):
     fail('Error: cannot find BAM file "'+bamfilename+'"')
 
-  bam_reader = Reader(bamfilename)
+  if options.index_file and not os.path.exists(options.index_file):
+    fail('Error: cannot find index file "'+options.index_file+'"')
+
+  bam_reader = Reader(bamfilename, index_filename=options.index_file or None,
+    threads=options.threads, use_mmap=options.mmap)
 
   FUNCTIONS[function](bam_reader, options)
 
@@ -92,6 +156,1014 @@ def BAMRead_indel_at(bam_reader, options):
         print "\t".join([str(indel_pos), indel_type, str(has_indel)])
 
 
+def open_indexed_copy(bam_reader, tmpdir, options):
+  """Write an indexed copy of the BAM into tmpdir and open it, or return the
+  reader itself when an index file was given."""
+  if options.index_file:
+    return bam_reader
+  bamfilename = os.path.join(tmpdir, 'indexed.bam')
+  writer = Writer(bamfilename, bam_reader._headers,
+    bam_reader.get_references(), index=True)
+  for read in bam_reader:
+    writer.write(read)
+  writer.close()
+  return Reader(bamfilename, threads=options.threads, use_mmap=options.mmap)
+
+
+def read_regions(regions_filename):
+  regions = []
+  with open(regions_filename) as regions_file:
+    for line in regions_file:
+      fields = line.split()
+      if fields:
+        regions.append((fields[0], int(fields[1]), int(fields[2])))
+  return regions
+
+
+def Reader_fetch(bam_reader, options):
+  """Fetch each region from an indexed copy of the BAM, or from the BAM with
+  the given index."""
+  if not options.regions_file:
+    fail('Error: Reader.fetch requires you to specify a regions file.')
+
+  regions = read_regions(options.regions_file)
+  tmpdir = tempfile.mkdtemp()
+  try:
+    indexed_reader = open_indexed_copy(bam_reader, tmpdir, options)
+    for (chrom, start, end) in regions:
+      print "\t".join([chrom, str(start), str(end)])
+      for read in indexed_reader.fetch(chrom, start, end):
+        print "\t"+"\t".join([read.get_read_name(), str(read.get_position()),
+          read.get_sam_cigar()])
+    indexed_reader.close()
+  finally:
+    shutil.rmtree(tmpdir)
+
+
+def Reader_fetch_many(bam_reader, options):
+  """Fetch all regions at once from an indexed copy of the BAM, or from the
+  BAM with the given index, printing each read with the indexes of the regions
+  it overlaps, then check those against fetch() of each region."""
+  if not options.regions_file:
+    fail('Error: Reader.fetch_many requires you to specify a regions file.')
+
+  regions = read_regions(options.regions_file)
+  tmpdir = tempfile.mkdtemp()
+  try:
+    indexed_reader = open_indexed_copy(bam_reader, tmpdir, options)
+    by_region = [[] for region in regions]
+    for (read, overlaps) in indexed_reader.fetch_many(regions):
+      print "\t".join([read.get_read_name(), str(read.get_position()),
+        ",".join(map(str, overlaps))])
+      for i in overlaps:
+        by_region[i].append(read.get_read_name())
+    for (i, (chrom, start, end)) in enumerate(regions):
+      fetched = [read.get_read_name()
+        for read in indexed_reader.fetch(chrom, start, end)]
+      print "\t".join([chrom, str(start), str(end), str(len(fetched)),
+        str(by_region[i] == fetched)])
+    indexed_reader.close()
+  finally:
+    shutil.rmtree(tmpdir)
+
+
+def Reader_filter(bam_reader, options):
+  """With a MAPQ 30 filter on an indexed copy of the BAM, or on the BAM with
+  the given index, print for each region the reads of fetch(), count(),
+  fetch_many() and jump(), and the records the filter saw."""
+  if not options.regions_file:
+    fail('Error: Reader.filter requires you to specify a regions file.')
+
+  regions = read_regions(options.regions_file)
+  tmpdir = tempfile.mkdtemp()
+  try:
+    indexed_reader = open_indexed_copy(bam_reader, tmpdir, options)
+    for (chrom, start, end) in regions:
+      record_filter = RecordFilter(min_mapq=30)
+      indexed_reader.set_filter(record_filter)
+      fetched = [read.get_read_name()
+        for read in indexed_reader.fetch(chrom, start, end)]
+      print "\t".join([chrom, str(start), str(end), "fetch",
+        ",".join(fetched), str(record_filter.get_stats())])
+      record_filter = RecordFilter(min_mapq=30)
+      indexed_reader.set_filter(record_filter)
+      print "\t".join([chrom, str(start), str(end), "count",
+        str(indexed_reader.count(chrom, start, end)),
+        str(record_filter.get_stats())])
+      record_filter = RecordFilter(min_mapq=30)
+      indexed_reader.set_filter(record_filter)
+      print "\t".join([chrom, str(start), str(end), "fetch_many",
+        ",".join([read.get_read_name() for (read, overlaps)
+          in indexed_reader.fetch_many([(chrom, start, end)])]),
+        str(record_filter.get_stats())])
+      record_filter = RecordFilter(min_mapq=30)
+      indexed_reader.set_filter(record_filter)
+      read = indexed_reader.jump(chrom, start)
+      print "\t".join([chrom, str(start), str(end), "jump",
+        read and read.get_read_name() or "None",
+        str(record_filter.get_stats())])
+    indexed_reader.close()
+  finally:
+    shutil.rmtree(tmpdir)
+
+
+def Reader_idxstats(bam_reader, options):
+  """Print the index statistics of an indexed copy of the BAM, or of the BAM
+  with the given index, then the read count of each reference."""
+  tmpdir = tempfile.mkdtemp()
+  try:
+    indexed_reader = open_indexed_copy(bam_reader, tmpdir, options)
+    for stats in indexed_reader.get_idxstats():
+      print "\t".join(map(str, stats))
+    for (name, length) in indexed_reader.get_references():
+      count = indexed_reader.count(name, 0, length)
+      if count:
+        print "\t".join([name, str(count)])
+    indexed_reader.close()
+  finally:
+    shutil.rmtree(tmpdir)
+
+
+def write_tiled_copy(bam_reader, tmpdir, copies, references=None):
+  """Write an indexed BAM of copies of the placed reads, each copy moved 20 kb
+  further along the first reference, and return its file name. references
+  replaces the references of the BAM."""
+  bam_reader.rewind()
+  reads = [read for read in bam_reader if read.get_position() > 0]
+  bamfilename = os.path.join(tmpdir, 'tiled.bam')
+  if references is None:
+    writer = Writer(bamfilename, bam_reader._headers,
+      bam_reader.get_references(), index=True)
+  else:
+    headers = "\n".join(["@HD\tVN:1.0\tSO:coordinate"] +
+      ["@SQ\tSN:%s\tLN:%i" % reference for reference in references])
+    writer = Writer(bamfilename, headers, references, index=True)
+  for copy in range(copies):
+    for read in reads:
+      read = BAMRead(read.get_bam_data()[4:], bam_reader)
+      read.set_reference_id(0)
+      read.set_position(read.get_position() + copy * 20000)
+      writer.write(read)
+  writer.close()
+  return bamfilename
+
+
+def print_cache_stats(label, reader):
+  stats = reader.get_cache_stats()
+  print "\t".join([label] + [key+"="+str(stats[key])
+    for key in ('hits', 'misses', 'entries')])
+
+
+def Reader_cache(bam_reader, options):
+  """Read a multi-block copy of the BAM through block caches of two sizes and
+  print the cache hits and misses after each pass, seek and fetch."""
+  tmpdir = tempfile.mkdtemp()
+  try:
+    bamfilename = write_tiled_copy(bam_reader, tmpdir, 100)
+    for cache_size in (2**26, 3 * 2**16):
+      print "cache_size="+str(cache_size)
+      reader = Reader(bamfilename, threads=options.threads,
+        cache_size=cache_size)
+      print_cache_stats("open", reader)
+      for i in range(2):
+        count = len(list(reader))
+        print_cache_stats("pass %i (%i reads)" % (i + 1, count), reader)
+        reader.rewind()
+      for i in range(3):
+        reader.seek_virtual(reader._first_read_offset)
+        reader.next()
+      print_cache_stats("seek_virtual x3", reader)
+      for i in range(2):
+        count = len(list(reader.fetch('chr1', 990000, 1010000)))
+        print_cache_stats("fetch %i (%i reads)" % (i + 1, count), reader)
+      reader.close()
+  finally:
+    shutil.rmtree(tmpdir)
+
+
+def print_pool_stats(label, pool):
+  stats = pool.get_stats()
+  print "\t".join([label] + [key+"="+str(stats[key])
+    for key in ('created', 'idle', 'checked_out', 'max_readers')])
+
+
+def ReaderPool_threads(bam_reader, options):
+  """Check readers out of a pool of 2 and back in, show that a third checkout
+  blocks until one is checked in, then fetch regions of a multi-block copy of
+  the BAM from 6 threads at once and compare to fetching them one by one."""
+  tmpdir = tempfile.mkdtemp()
+  try:
+    bamfilename = write_tiled_copy(bam_reader, tmpdir, 50)
+    regions = [('chr1', start, start + 30000)
+      for start in range(0, 1000000, 70000)]
+    pool = ReaderPool(bamfilename, threads=options.threads, max_readers=2)
+    print_pool_stats("open", pool)
+    first = pool.checkout()
+    first_name = first.next().get_read_name()
+    second = pool.checkout(record_filter=RecordFilter(min_mapq=30))
+    print_pool_stats("checkout x2", pool)
+    checked_out = []
+    got_reader = threading.Event()
+    def checkout_third():
+      checked_out.append(pool.checkout())
+      got_reader.set()
+    thread = threading.Thread(target=checkout_third)
+    thread.start()
+    print "\t".join(["third checkout blocked",
+      str(not got_reader.wait(0.5))])
+    pool.checkin(first)
+    print "\t".join(["third checkout after checkin",
+      str(got_reader.wait(10))])
+    thread.join()
+    print "\t".join(["reused the checked in reader",
+      str(checked_out[0] is first), "rewound",
+      str(checked_out[0].next().get_read_name() == first_name)])
+    print_pool_stats("checkout x3, checkin x1", pool)
+    pool.checkin(checked_out[0])
+    pool.checkin(second)
+    print_pool_stats("checkin x3", pool)
+    with pool.reader() as reader:
+      print "\t".join(["reader() filter cleared",
+        str(reader._record_filter is None)])
+    serial = [[read.get_read_name() for read in pool.fetch(*region)]
+      for region in regions]
+    print "\t".join(["serial fetch", str(len(regions)), "regions",
+      str(sum([len(names) for names in serial])), "reads"])
+    results = {}
+    def fetch_regions(thread_index):
+      for i in range(len(regions)):
+        i = (i + thread_index) % len(regions)
+        names = [read.get_read_name() for read in pool.fetch(*regions[i])]
+        results[(thread_index, i)] = names
+    threads = [threading.Thread(target=fetch_regions, args=(thread_index,))
+      for thread_index in range(6)]
+    for thread in threads:
+      thread.start()
+    for thread in threads:
+      thread.join()
+    print "\t".join(["concurrent fetch", str(len(results)), "results",
+      "identical", str(all([results[(thread_index, i)] == serial[i]
+        for (thread_index, i) in results]))])
+    print_pool_stats("after concurrent fetch", pool)
+    pool.close()
+    pool = ReaderPool(bamfilename, threads=options.threads, max_readers=1)
+    def fail_clone(**kwds):
+      raise IOError("clone failed")
+    pool._reader.clone = fail_clone
+    for i in range(2):
+      try:
+        pool.checkout()
+      except IOError:
+        print_pool_stats("failed checkout %i" % (i + 1), pool)
+    del pool._reader.clone
+    got_reader.clear()
+    def checkout_after_failures():
+      checked_out.append(pool.checkout())
+      got_reader.set()
+    thread = threading.Thread(target=checkout_after_failures)
+    thread.start()
+    print "\t".join(["checkout after failed clones", str(got_reader.wait(10))])
+    thread.join()
+    pool.checkin(checked_out[-1])
+    print_pool_stats("checkin", pool)
+    pool.close()
+  finally:
+    shutil.rmtree(tmpdir)
+
+
+def next_async_reads(loop, async_iterator):
+  """Drive an async iterator to its end from outside a coroutine."""
+  reads = []
+  while True:
+    try:
+      reads.append(loop.run_until_complete(async_iterator.__anext__()))
+    except aio.StopAsyncIteration:
+      return reads
+
+
+def AsyncReader_fetch(bam_reader, options):
+  """Await fetch(), fetch_many(), jump() and iter_reads() on a multi-block
+  copy of the BAM and compare them to the Reader, then iterate over a
+  truncated copy and check that the failing iterator gives its reader back."""
+  if aio.asyncio is None:
+    fail('Error: AsyncReader requires asyncio, or trollius on Python 2.')
+  tmpdir = tempfile.mkdtemp()
+  try:
+    bamfilename = write_tiled_copy(bam_reader, tmpdir, 50)
+    regions = [('chr1', start, start + 30000)
+      for start in range(0, 1000000, 70000)]
+    reader = Reader(bamfilename)
+    loop = aio.asyncio.new_event_loop()
+    async_reader = aio.AsyncReader(bamfilename, loop=loop, max_readers=2,
+      threads=options.threads)
+    names = lambda reads: [read.get_read_name() for read in reads]
+    fetched = loop.run_until_complete(aio.asyncio.gather(
+      *[async_reader.fetch(*region) for region in regions]))
+    print "\t".join(["fetch", str(len(regions)), "regions", "identical",
+      str([names(reads) for reads in fetched] ==
+        [names(reader.fetch(*region)) for region in regions])])
+    fetched = loop.run_until_complete(async_reader.fetch_many(regions))
+    print "\t".join(["fetch_many", str(len(fetched)), "reads", "identical",
+      str([(read.get_read_name(), overlaps) for (read, overlaps) in fetched]
+        == [(read.get_read_name(), overlaps) for (read, overlaps)
+          in reader.fetch_many(regions)])])
+    jumped = loop.run_until_complete(async_reader.jump('chr1', 500000, 5))
+    reader.jump('chr1', 500000, next=False)
+    print "\t".join(["jump", ",".join(names(jumped)), "identical",
+      str(names(jumped) == [reader.next().get_read_name()
+        for i in range(5)])])
+    iterated = next_async_reads(loop, async_reader.iter_reads('chr1', 100000,
+      400000, batch_size=7))
+    print "\t".join(["iter_reads", str(len(iterated)), "reads", "identical",
+      str(names(iterated) == names(reader.fetch('chr1', 100000, 400000)))])
+    reader.rewind()
+    iterated = next_async_reads(loop, async_reader.iter_reads(batch_size=100))
+    print "\t".join(["iter_reads all", str(len(iterated)), "reads",
+      "identical", str(names(iterated) == names(reader))])
+    print "\t".join(["checked_out",
+      str(async_reader.get_pool().get_stats()['checked_out'])])
+    async_reader.close()
+    truncatedfilename = os.path.join(tmpdir, 'truncated.bam')
+    with open(bamfilename, 'rb') as bam_file:
+      data = bam_file.read()
+    with open(truncatedfilename, 'wb') as truncated_file:
+      truncated_file.write(data[:len(data) / 2])
+    shutil.copy(bamfilename+'.bai', truncatedfilename+'.bai')
+    async_reader = aio.AsyncReader(truncatedfilename, loop=loop,
+      max_readers=2, threads=options.threads)
+    for i in range(2):
+      try:
+        next_async_reads(loop, async_reader.iter_reads(batch_size=100))
+        error = "none"
+      except IOError, e:
+        error = e.__class__.__name__
+      print "\t".join(["truncated iter_reads %i" % (i + 1), error])
+    print "\t".join(["checked_out",
+      str(async_reader.get_pool().get_stats()['checked_out'])])
+    async_reader.close()
+    loop.close()
+    reader.close()
+  finally:
+    shutil.rmtree(tmpdir)
+
+
+def Reader_next_batch(bam_reader, options):
+  """Read a multi-block copy of the BAM in batches, check every column against
+  the BAMRead fetched back from the batch offset with get_read_at(), and check
+  that the batches cover every record once, in file order."""
+  BATCH_READ_FIELDS = [
+    ('ref_id', lambda read: read.get_reference_id()),
+    ('pos', lambda read: read.get_position(one_based=False)),
+    ('end', lambda read: read.get_end_position(one_based=False)),
+    ('flag', lambda read: read.get_flag()),
+    ('mapq', lambda read: read.get_mapq()),
+    ('l_seq', lambda read: read.get_l_seq()),
+    ('next_ref_id', lambda read: read.get_rnext_id()),
+    ('next_pos', lambda read: read.get_pnext(one_based=False)),
+    ('t_len', lambda read: read.get_t_len()),
+  ]
+  tmpdir = tempfile.mkdtemp()
+  try:
+    bamfilename = write_tiled_copy(bam_reader, tmpdir, 20)
+    reader = Reader(bamfilename, threads=options.threads)
+    records = []
+    while True:
+      offset = reader.tell_virtual()
+      try:
+        records.append((offset[0] << 16 | offset[1], reader.next_raw()))
+      except StopIteration:
+        break
+    reader.rewind()
+    sizes = []
+    offsets = []
+    mismatches = dict((name, 0) for (name, get_value) in BATCH_READ_FIELDS)
+    round_trips = 0
+    for batch in reader.iter_batches(size=150):
+      sizes.append(len(batch['offset']))
+      for (row, offset) in enumerate(batch['offset']):
+        offsets.append(int(offset))
+        read = reader.get_read_at(offset)
+        for (name, get_value) in BATCH_READ_FIELDS:
+          if batch[name][row] != get_value(read):
+            mismatches[name] += 1
+        if read.get_bam_data()[4:] == records[len(offsets) - 1][1]:
+          round_trips += 1
+    print "\t".join(["records", str(len(records)), "batches", str(len(sizes)),
+      "sizes", ",".join(sorted(set(map(str, sizes))))])
+    print "\t".join(["offsets match", str(offsets == [offset
+      for (offset, data) in records])])
+    print "\t".join(["round trips", str(round_trips)])
+    print "\t".join([name+"="+str(mismatches[name])
+      for (name, get_value) in BATCH_READ_FIELDS])
+    reader.close()
+  finally:
+    shutil.rmtree(tmpdir)
+
+
+def bgzf_gzi(bam_reader, options):
+  """Build, save and load the GZI index of a multi-block copy of the BAM, then
+  read from uncompressed offsets around every block boundary and compare with
+  the decompressed file."""
+  tmpdir = tempfile.mkdtemp()
+  try:
+    bamfilename = write_tiled_copy(bam_reader, tmpdir, 100)
+    data = read_bgzf(bamfilename)
+    bgzf_reader = BGZFReader(bamfilename, threads=options.threads)
+    index = bgzf_reader.build_gzi_index()
+    print "\t".join(["blocks", str(len(index)), "uncompressed", str(len(data))])
+    gzifilename = bamfilename+'.gzi'
+    index.save(gzifilename)
+    bgzf_reader.close()
+    bgzf_reader = BGZFReader(bamfilename, threads=options.threads)
+    loaded_index = bgzf_reader.load_gzi_index()
+    print "\t".join(["loaded", str(len(loaded_index)), "same",
+      str(loaded_index._compressed_offsets == index._compressed_offsets and
+        loaded_index._uncompressed_offsets == index._uncompressed_offsets)])
+    positions = [0, len(data) - 5]
+    for boundary in loaded_index._uncompressed_offsets[1:]:
+      positions.extend([boundary - 10, boundary])
+    for position in positions:
+      for size in (30, 3 * 0xff00):
+        virtual_offset = bgzf_reader.seek_uncompressed(position)
+        print "\t".join([str(position), str(size), str(virtual_offset),
+          str(bgzf_reader.read(size) == data[position:position + size])])
+    bgzf_reader.close()
+  finally:
+    shutil.rmtree(tmpdir)
+
+
+def bgzf_truncated(bam_reader, options):
+  """Read copies of the BAM cut off within the magic, header, compressed data
+  and trailer of its second block with each kind of BGZF reader, and print the
+  blocks read and the error raised."""
+  tmpdir = tempfile.mkdtemp()
+  try:
+    data = open(bam_reader._filename, 'rb').read()
+    second_block, size = list(scan_blocks(bam_reader._filename))[1][:2]
+    for cut in (2, 10, 100, size - 3):
+      filename = os.path.join(tmpdir, 'cut.bam')
+      with open(filename, 'wb') as fh:
+        fh.write(data[:second_block + cut])
+      for reader_class in (BGZFReader, BGZFMmapReader, BGZFStreamReader):
+        bgzf_reader = reader_class(filename, threads=options.threads)
+        blocks = 0
+        try:
+          while True:
+            bgzf_reader.next()
+            blocks += 1
+        except Exception, e:
+          error = e.__class__.__name__+": "+str(e).replace(filename, 'cut.bam')
+        bgzf_reader.close()
+        print "\t".join([str(second_block + cut), reader_class.__name__,
+          str(blocks), error])
+  finally:
+    shutil.rmtree(tmpdir)
+
+
+def bgzf_block_stats(bam_reader, options):
+  """Print get_block_stats() of the BAM and of damaged copies of it, and
+  whether anything was written to stderr while collecting them."""
+  tmpdir = tempfile.mkdtemp()
+  try:
+    data = open(bam_reader._filename, 'rb').read()
+    blocks = list(scan_blocks(bam_reader._filename))
+    second_block = blocks[1][0]
+    eof_block = blocks[-1][0]
+    copies = [
+      ('intact', data),
+      ('junk between blocks', data[:second_block]+'J'*80+data[second_block:]),
+      ('short trailing junk', data+'J'*10),
+      ('partial trailing header', data+data[:10]),
+      ('cut within a block', data[:second_block + 100]),
+      ('no EOF marker', data[:eof_block]),
+      ('empty', ''),
+    ]
+    for (name, copy) in copies:
+      filename = os.path.join(tmpdir, 'copy.bam')
+      with open(filename, 'wb') as fh:
+        fh.write(copy)
+      stderr = sys.stderr
+      sys.stderr = StringIO()
+      try:
+        stats = get_block_stats(filename)
+        warned = bool(sys.stderr.getvalue())
+      finally:
+        sys.stderr = stderr
+      print "\t".join([name] + [key+"="+str(stats[key]) for key in sorted(stats)]
+        + ["stderr="+str(warned)])
+  finally:
+    shutil.rmtree(tmpdir)
+
+
+def bgzf_extra_subfields(bam_reader, options):
+  """Rewrite the BAM with a gzip extra subfield before BC in every block but the
+  fixed EOF marker, as the BGZF spec allows, then scan, inflate and parse the
+  copy with each reader and compare with the original."""
+  tmpdir = tempfile.mkdtemp()
+  try:
+    data = open(bam_reader._filename, 'rb').read()
+    blocks = list(scan_blocks(bam_reader._filename))
+    copy = []
+    for (offset, size, uncompressed_size) in blocks[:-1]:
+      # 12 bytes of fixed header, XLEN grows by the 7 byte 'XY' subfield.
+      copy.append(data[offset:offset+10] + struct.pack('<H', 13) + 'XY' +
+        struct.pack('<H', 3) + 'abc' + 'BC' + struct.pack('<HH', 2, size + 6) +
+        data[offset+18:offset+size])
+    copy.append(data[blocks[-1][0]:])
+    filename = os.path.join(tmpdir, 'extra.bam')
+    with open(filename, 'wb') as fh:
+      fh.write("".join(copy))
+    copy_blocks = list(scan_blocks(filename))
+    print "\t".join(["scan_blocks", str(len(copy_blocks)),
+      str([block[1] - 7 for block in copy_blocks[:-1]] + [copy_blocks[-1][1]] ==
+        [block[1] for block in blocks]),
+      str([block[2] for block in copy_blocks] == [block[2] for block in blocks])])
+    stats = get_block_stats(filename)
+    print "\t".join(["get_block_stats"] + [key+"="+str(stats[key]) for key in
+      sorted(stats)])
+    expected = read_bgzf(bam_reader._filename)
+    for reader_class in (BGZFReader, BGZFMmapReader, BGZFStreamReader):
+      bgzf_reader = reader_class(filename, threads=options.threads)
+      chunks = []
+      while True:
+        try:
+          chunks.append(bgzf_reader.next())
+        except StopIteration:
+          break
+      bgzf_reader.close()
+      print "\t".join([reader_class.__name__, str(len(chunks)),
+        str("".join(chunks) == expected)])
+    bam_reader.rewind()
+    names = [read.get_read_name() for read in bam_reader]
+    reader = Reader(filename)
+    print "\t".join(["Reader", str(len(names)),
+      str([read.get_read_name() for read in reader] == names)])
+    reader.close()
+  finally:
+    shutil.rmtree(tmpdir)
+
+
+def write_bgzf(filename, chunks, many=False, **kwds):
+  """Write the chunks to a BGZF file, one write() each or all in one
+  write_many(), and return the bytes of the file."""
+  bgzf_writer = BGZFWriter(filename, **kwds)
+  if many:
+    bgzf_writer.write_many(iter(chunks))
+  else:
+    for chunk in chunks:
+      bgzf_writer.write(chunk)
+  bgzf_writer.close()
+  return open(filename, 'rb').read()
+
+
+def bgzf_writer(bam_reader, options):
+  """Write multi-block copies of the decompressed BAM and compare threaded
+  with unthreaded output at several levels, and write_many() with write().
+  Then check the block size limit on incompressible data, and the deflate
+  backend chosen when isal, zlib-ng and a backend listed before them cannot
+  be imported."""
+  if bam_reader._filename == '-':
+    fail('Error: bgzf.Writer needs a BAM file, not stdin.')
+  tmpdir = tempfile.mkdtemp()
+  try:
+    data = read_bgzf(bam_reader._filename) * 40
+    filename = os.path.join(tmpdir, 'copy.bgzf')
+    chunks = []
+    offset = 0
+    for size in itertools.cycle((1, 7, 300, 5000, 70000)):
+      if offset >= len(data):
+        break
+      chunks.append(data[offset:offset + size])
+      offset += size
+    for level in (0, 1, 6, 9):
+      unthreaded = write_bgzf(filename, chunks, compress_level=level,
+        backend='zlib')
+      blocks = len(list(scan_blocks(filename)))
+      threaded = write_bgzf(filename, chunks, compress_level=level,
+        backend='zlib', threads=3, max_pending=2)
+      many = write_bgzf(filename, chunks, many=True, compress_level=level,
+        backend='zlib')
+      print "\t".join(["level", str(level), str(blocks), "blocks",
+        "threaded identical", str(threaded == unthreaded),
+        "write_many identical", str(many == unthreaded),
+        "reads back", str(read_bgzf(filename) == data)])
+
+    random_data = "".join([chr(byte) for byte
+      in random.Random(1).sample(range(256) * 1200, 300000)])
+    for (level, threads) in ((0, 0), (9, 0), (9, 2)):
+      write_bgzf(filename, [random_data], compress_level=level,
+        backend='zlib', threads=threads)
+      block_sizes = [size for (offset, size, uncompressed_size)
+        in scan_blocks(filename)]
+      print "\t".join(["incompressible", "level", str(level), "threads",
+        str(threads), str(len(block_sizes)), "blocks",
+        "largest <= 65536", str(max(block_sizes) <= 65536),
+        "reads back", str(read_bgzf(filename) == random_data)])
+
+    missing = ('isal', 'isal.isal_zlib', 'zlib_ng', 'zlib_ng.zlib_ng')
+    saved = dict([(name, sys.modules.get(name)) for name in missing])
+    for name in missing:
+      sys.modules[name] = None #makes importing it fail
+    #a backend that can never be imported, so that the fallback is also taken
+    #on Python 2, where isal and zlib-ng are skipped without importing them
+    bgzf_module.DEFLATE_BACKENDS.insert(0,
+      ('nomodule', 'pyBamParser_no_such_module', 9, (2,)))
+    try:
+      print "\t".join(["default backend without isal and zlib-ng",
+        get_deflate_backend().name, "available",
+        ",".join([backend.name for backend in get_available_deflate_backends()])])
+      for name in ('nomodule', 'isal', 'zlib-ng', 'nonesuch'):
+        try:
+          get_deflate_backend(name)
+          result = "loaded"
+        except ImportError:
+          result = "ImportError"
+        except ValueError:
+          result = "ValueError"
+        print "\t".join(["backend", name, result])
+      fallback = write_bgzf(filename, chunks, compress_level=6)
+      print "\t".join(["default backend output identical to zlib",
+        str(fallback == write_bgzf(filename, chunks, compress_level=6,
+          backend='zlib'))])
+    finally:
+      del bgzf_module.DEFLATE_BACKENDS[0]
+      for name in missing:
+        if saved[name] is None:
+          del sys.modules[name]
+        else:
+          sys.modules[name] = saved[name]
+  finally:
+    shutil.rmtree(tmpdir)
+
+
+def read_bgzf(filename):
+  """Return the decompressed contents of a BGZF file."""
+  bgzf_reader = BGZFReader(filename)
+  blocks = []
+  while True:
+    try:
+      blocks.append(bgzf_reader.next())
+    except StopIteration:
+      break
+  bgzf_reader.close()
+  return "".join(blocks)
+
+
+def Writer_copy(bam_reader, options):
+  """Copy the BAM unmodified and compare its decompressed bytes, then copy it
+  with the MAPQ and position of every read changed and print the reads as they
+  read back."""
+  if bam_reader._filename == '-':
+    fail('Error: Writer.copy needs a BAM file, not stdin.')
+  tmpdir = tempfile.mkdtemp()
+  try:
+    copyfilename = os.path.join(tmpdir, 'copy.bam')
+    writer = Writer(copyfilename, bam_reader._headers,
+      bam_reader.get_references())
+    for read in bam_reader:
+      writer.write(read)
+    writer.close()
+    if read_bgzf(copyfilename) == read_bgzf(bam_reader._filename):
+      print "unmodified copy: identical"
+    else:
+      print "unmodified copy: differs"
+
+    bam_reader.rewind()
+    modifiedfilename = os.path.join(tmpdir, 'modified.bam')
+    writer = Writer(modifiedfilename, bam_reader._headers,
+      bam_reader.get_references())
+    for read in bam_reader:
+      if read.get_position() > 0:
+        read.set_mapq((read.get_mapq() + 1) % 255)
+        read.set_position(read.get_position() + 100000)
+      writer.write(read)
+    writer.close()
+
+    modified_reader = Reader(modifiedfilename)
+    for read in modified_reader:
+      pos = read.get_position(one_based=False)
+      if pos < 0:
+        expected_bin = 4680
+      else:
+        expected_bin = reg2bin(pos, max(read.get_end_position(one_based=False),
+          pos + 1))
+      print "\t".join([read.get_read_name(), str(read.get_position()),
+        str(read.get_mapq()), read.get_sam_cigar(), str(read._bin),
+        str(read._bin == expected_bin)])
+    modified_reader.close()
+  finally:
+    shutil.rmtree(tmpdir)
+
+
+def get_uncompressed_offsets(filename):
+  """The uncompressed offset of the start of each BGZF block, by its
+  compressed offset."""
+  block_offsets = {}
+  uncompressed_offset = 0
+  for (offset, size, uncompressed_size) in scan_blocks(filename):
+    block_offsets[offset] = uncompressed_offset
+    uncompressed_offset += uncompressed_size
+  return block_offsets
+
+
+def get_record_offsets(reader):
+  """The uncompressed offset of each record of the reader, then that of its
+  end, and the ( reference id, start, end ) of each record."""
+  block_offsets = get_uncompressed_offsets(reader._filename)
+  reader.rewind()
+  offsets = [reader.tell_virtual()]
+  spans = []
+  for read in reader:
+    offsets.append(reader.tell_virtual())
+    pos = read.get_position(one_based=False)
+    spans.append((read.get_reference_id(), pos,
+      max(read.get_end_position(one_based=False), pos + 1)))
+  reader.rewind()
+  return ([block_offsets[offset] + within for (offset, within) in offsets],
+    spans)
+
+
+def get_chunk_records(reader, offsets, seq_name, start, end):
+  """The chunks of a region in the reader's index, as the numbers of the
+  records they span, so that indexes of files with different blocks compare."""
+  block_offsets = get_uncompressed_offsets(reader._filename)
+  return [(bisect.bisect_left(offsets, block_offsets[chunk_beg[0]] + chunk_beg[1]),
+    bisect.bisect_left(offsets, block_offsets[chunk_end[0]] + chunk_end[1]))
+    for (chunk_beg, chunk_end) in reader._bam_index.get_chunks(seq_name, start, end)]
+
+
+def Writer_index(bam_reader, options):
+  """Copy the BAM with index=True and close the writer twice, then check the
+  index statistics, chunks and fetches of each region against the given index
+  of the BAM. Chunks are printed as ranges of record numbers; samtools merges
+  small bins into their parents, so its chunks can be looser, but the chunks
+  of both indexes must hold every record overlapping the region."""
+  if not (options.regions_file and options.index_file):
+    fail('Error: Writer.index requires a regions file and an index file.')
+  regions = read_regions(options.regions_file)
+  tmpdir = tempfile.mkdtemp()
+  try:
+    copyfilename = os.path.join(tmpdir, 'copy.bam')
+    writer = Writer(copyfilename, bam_reader._headers,
+      bam_reader.get_references(), index=True)
+    for read in bam_reader:
+      writer.write(read)
+    writer.close()
+    writer.close()
+    print "\t".join(["closed twice", str(os.path.exists(copyfilename+'.bai'))])
+    copy_reader = Reader(copyfilename)
+    copy_stats = copy_reader.get_idxstats()
+    for stats in copy_stats:
+      if stats[2] or stats[3]:
+        print "\t".join(map(str, stats))
+    print "\t".join(["idxstats identical",
+      str(copy_stats == bam_reader.get_idxstats())])
+    (copy_offsets, spans) = get_record_offsets(copy_reader)
+    (offsets, spans) = get_record_offsets(bam_reader)
+    for (chrom, start, end) in regions:
+      seq_id = bam_reader.get_reference_id_by_name(chrom)
+      overlapping = [i for (i, (ref_id, read_start, read_end))
+        in enumerate(spans) if ref_id == seq_id and read_start < end
+        and read_end > start]
+      covered = []
+      for (reader, record_offsets) in ((copy_reader, copy_offsets),
+          (bam_reader, offsets)):
+        chunks = get_chunk_records(reader, record_offsets, chrom, start, end)
+        covered.append(all([any([chunk_beg <= i < chunk_end
+          for (chunk_beg, chunk_end) in chunks]) for i in overlapping]))
+        print "\t".join([chrom, str(start), str(end), str(chunks)])
+      fetched = [read.get_read_name()
+        for read in copy_reader.fetch(chrom, start, end)]
+      expected = [read.get_read_name()
+        for read in bam_reader.fetch(chrom, start, end)]
+      print "\t".join([chrom, str(start), str(end), "chunks hold",
+        str(len(overlapping)), "overlapping records", str(covered[0]),
+        str(covered[1]), "fetch identical", str(fetched == expected)])
+    copy_reader.close()
+  finally:
+    shutil.rmtree(tmpdir)
+
+def sort_bam_orders(bam_reader, options):
+  """Sort the BAM by read name, then sort that by coordinate, with a memory
+  limit small enough to spill several runs, and print each result."""
+  if bam_reader._filename == '-':
+    fail('Error: sort_bam needs a BAM file, not stdin.')
+  tmpdir = tempfile.mkdtemp()
+  try:
+    inputfilename = bam_reader._filename
+    for (sort_order, key_func) in (('queryname', get_queryname_key),
+        ('coordinate', get_coordinate_key)):
+      sortedfilename = os.path.join(tmpdir, sort_order+'.bam')
+      stats = sort_bam(inputfilename, sortedfilename, sort_order=sort_order,
+        max_memory=4096, threads=options.threads, tmp_dir=tmpdir)
+      sorted_reader = Reader(sortedfilename)
+      print "\t".join([sort_order, sorted_reader._headers.split('\n')[0]])
+      print "\t".join(["records", str(stats['records']), "runs",
+        str(stats['runs'])])
+      keys = []
+      for read in sorted_reader:
+        keys.append(key_func(read.get_bam_data()[4:]))
+        print "\t"+"\t".join([read.get_read_name(), str(read.get_flag()),
+          str(read.get_position())])
+      print "\t".join(["in order", str(keys == sorted(keys)), "read",
+        str(len(keys))])
+      sorted_reader.close()
+      inputfilename = sortedfilename
+  finally:
+    shutil.rmtree(tmpdir)
+
+
+def failing_write_run(filename, records, threads):
+  """A sort run writer that fails, as on a full disk."""
+  raise IOError("No space left on device: "+os.path.basename(filename))
+
+
+def lossy_write_run(filename, records, threads):
+  """A sort run writer that loses the last record of each run."""
+  write_run(filename, records[:-1], threads)
+
+
+write_run = sort_module._write_run
+
+
+def sort_bam_errors(bam_reader, options):
+  """Sort the BAM with run writers that fail or lose records, and print the
+  error sort_bam raises and whether it left its output, index or spill
+  directory behind."""
+  if bam_reader._filename == '-':
+    fail('Error: sort_bam needs a BAM file, not stdin.')
+  tmpdir = tempfile.mkdtemp()
+  try:
+    for (run_writer, index) in ((failing_write_run, False),
+        (lossy_write_run, False), (lossy_write_run, True)):
+      sortedfilename = os.path.join(tmpdir, run_writer.__name__+'.bam')
+      sort_module._write_run = run_writer
+      try:
+        stats = sort_bam(bam_reader._filename, sortedfilename,
+          max_memory=4096, threads=options.threads, tmp_dir=tmpdir,
+          index=index)
+        error = "none, records "+str(stats['records'])
+      except IOError, e:
+        error = e.__class__.__name__+": "+str(e).replace(bam_reader._filename,
+          os.path.basename(bam_reader._filename))
+      finally:
+        sort_module._write_run = write_run
+      print "\t".join([run_writer.__name__, "index="+str(index), error,
+        "output left "+str(os.path.exists(sortedfilename)), "index left "
+        +str(os.path.exists(sortedfilename+'.bai')), "spill directories left "
+        +str(len([name for name in os.listdir(tmpdir)
+          if name.startswith('pyBamParser_sort_')]))])
+  finally:
+    shutil.rmtree(tmpdir)
+
+
+def mate_pairs(bam_reader, options):
+  """Pair the reads with room for only 2 reads waiting for their mates, with
+  the reads that do not fit spilled to disk, then dropped as orphans."""
+  if bam_reader._filename == '-':
+    fail('Error: MatePairer needs a BAM file, not stdin.')
+  for spill in (True, False):
+    print "spill="+str(spill)
+    bam_reader.rewind()
+    pairer = MatePairer(bam_reader, max_pending=2, spill=spill,
+      yield_orphans=True)
+    for pair in pairer:
+      print "\t"+"\t".join([read and ":".join([read.get_read_name(),
+        str(read.get_flag()), str(read.get_reference_id()),
+        str(read.get_position())]) or "None" for read in pair])
+    stats = pairer.get_stats()
+    print "\t".join([key+"="+str(stats[key]) for key in sorted(stats)])
+
+
+def shard_reads(reads, shard):
+  """The name, start and end of the reads of a shard (for map_shards)."""
+  return [(read.get_read_name(), read.get_position(one_based=False),
+    read.get_end_position(one_based=False)) for read in reads]
+
+
+def shard_read_count(reads, shard):
+  return sum(1 for read in reads)
+
+
+def parallel_shards(bam_reader, options):
+  """Run map_shards() over 7 kb shards of a tiled copy of the BAM, in this
+  process and in a pool of 2, and check that every read is seen once, in the
+  shard holding its start, including reads that span a shard boundary."""
+  tmpdir = tempfile.mkdtemp()
+  try:
+    bamfilename = write_tiled_copy(bam_reader, tmpdir, 100,
+      references=[('chr1', 2000000), ('chr2', 5000)])
+    tiled_reader = Reader(bamfilename)
+    all_reads = sorted((read.get_read_name(), read.get_position(one_based=False),
+      read.get_end_position(one_based=False)) for read in tiled_reader)
+    tiled_reader.close()
+    for processes in (1, 2):
+      shards = []
+      seen = []
+      spanning = 0
+      in_shard = True
+      for (shard, reads) in zip(get_shard_list(bamfilename, 7000),
+          map_shards(bamfilename, shard_reads, shard_size=7000,
+            processes=processes)):
+        shards.append(shard)
+        for (name, start, end) in reads:
+          in_shard = in_shard and shard[1] <= start < shard[2]
+          if end > shard[2]:
+            spanning += 1
+        seen.extend(reads)
+      print "\t".join(["processes="+str(processes), "shards="+str(len(shards)),
+        "reads="+str(len(seen)), "spanning="+str(spanning),
+        "in_shard="+str(in_shard), "exactly_once="+str(sorted(seen) == all_reads)])
+      print "\t".join(["map_reduce", str(map_reduce(bamfilename,
+        shard_read_count, reduce_func=lambda total, count: total + count,
+        initial=0, shard_size=7000, processes=processes))])
+  finally:
+    shutil.rmtree(tmpdir)
+
+
+def get_shard_list(bamfilename, shard_size):
+  shard_reader = Reader(bamfilename)
+  shards = get_shards(shard_reader, shard_size)
+  shard_reader.close()
+  return shards
+
+
+def pileup_indels(bam_reader, options):
+  """Print the pileup columns that hold anything but aligned bases."""
+  PILEUP_STATE_CHARS = {1:'*', 2:'>'}
+  for (ref_id, pos, entries) in pileup(bam_reader):
+    if all(entry[4] == PILEUP_MATCH and not entry[5] for entry in entries):
+      continue
+    bases = "".join([entry[2] or PILEUP_STATE_CHARS[entry[4]] for entry in entries])
+    indels = ",".join([str(entry[5]) for entry in entries if entry[5]])
+    print "\t".join([bam_reader.get_reference_name_by_id(ref_id), str(pos + 1),
+      str(len(entries)), bases, indels])
+
+
+def pileup_columns(bam_reader, options):
+  """Print every pileup column, with the read name, query offset, base and
+  quality of each entry ('.' for None)."""
+  PILEUP_STATE_CHARS = {0:'', 1:'*', 2:'>'}
+  for (ref_id, pos, entries) in pileup(bam_reader):
+    print "\t".join([bam_reader.get_reference_name_by_id(ref_id), str(pos + 1),
+      str(len(entries))] + [":".join([entry[0].get_read_name(), str(entry[1]),
+      str(entry[2] or "."), str("." if entry[3] is None else entry[3])])
+      + PILEUP_STATE_CHARS[entry[4]] for entry in entries])
+
+
+def get_depth_runs(bam_reader, options):
+  """Print the runs of equal depth over each reference, with all bases counted
+  and with bases below quality 20 left out."""
+  for (name, length) in bam_reader.get_references():
+    for min_base_quality in (0, 20):
+      bam_reader.rewind()
+      depth = get_depth(bam_reader, name, 0, length,
+        min_base_quality=min_base_quality)
+      print "\t".join([name, "min_base_quality="+str(min_base_quality)])
+      start = 0
+      for pos in range(1, length + 1):
+        if pos == length or depth[pos] != depth[start]:
+          if depth[start]:
+            print "\t"+"\t".join([str(start), str(pos), str(depth[start])])
+          start = pos
+
+
+def bedgraph_windows(bam_reader, options):
+  """Write the bedGraph with a 7 base window, so that blocks carry over from
+  window to window, then check that other window sizes give the same runs and
+  that they match get_depth() on the references of at most 100 kb."""
+  for include_zero in (False, True):
+    print "include_zero="+str(include_zero)
+    bedgraph = StringIO()
+    write_bedgraph(bam_reader, bedgraph, include_zero=include_zero,
+      window_size=7)
+    sys.stdout.write(bedgraph.getvalue())
+    runs = [(ref_name, int(start), int(end), int(depth)) for (ref_name, start,
+      end, depth) in [line.split("\t") for line in
+      bedgraph.getvalue().splitlines()]]
+    for window_size in (1, 50, 1000, None):
+      kwds = window_size and {'window_size': window_size} or {}
+      print "\t".join(["window_size="+str(window_size), "identical",
+        str(list(iter_bedgraph(bam_reader, include_zero=include_zero,
+          **kwds)) == runs)])
+    depth_runs = []
+    names = set()
+    for (name, length) in bam_reader.get_references():
+      if length > 100000:
+        continue
+      names.add(name)
+      bam_reader.rewind()
+      depth = get_depth(bam_reader, name, 0, length)
+      start = 0
+      for pos in range(1, length + 1):
+        if pos == length or depth[pos] != depth[start]:
+          if depth[start] or include_zero:
+            depth_runs.append((name, start, pos, int(depth[start])))
+          start = pos
+    print "\t".join(["get_depth", "identical", str([run for run in runs
+      if run[0] in names] == depth_runs)])
+
+
 def fail(message):
   sys.stderr.write(message+"\n")
   sys.exit(1)